@@ -9,8 +9,13 @@ https://docs.djangoproject.com/en/3.0/howto/deployment/asgi/
 
 import os
 
-from django.core.asgi import get_asgi_application
+import django
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'DailyFeed.settings')
 
-application = get_asgi_application()
+django.setup(set_prefix=False)
+
+# Waits for feeds on the event loop, see feed.asgi
+from feed.asgi import FeedASGIHandler  # noqa: E402
+
+application = FeedASGIHandler()
@@ -48,6 +48,7 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'feed.middleware.ServerTimingMiddleware',
 ]
 
 ROOT_URLCONF = 'DailyFeed.urls'
@@ -107,6 +108,54 @@ CACHES = {
    }
 }
 
+# Feed fetching
+# Timeout (seconds) for single feed and for the whole batch fetched by CategoryView
+
+FEED_FETCH_TIMEOUT = 10
+FEED_FETCH_WORKERS = 16
+FEED_FETCH_PER_HOST = 2
+
+# Where downloaded feeds are parsed and matched with tags of categories: 'inline' (in fetching
+# thread), 'thread' or 'process' (pool of FEED_PARSE_WORKERS processes, one per core by default)
+
+FEED_PARSE_BACKEND = 'inline'
+FEED_PARSE_WORKERS = None
+
+# Deadline (seconds) for validation of all feeds imported from OPML file
+
+FEED_IMPORT_TIMEOUT = 60
+
+# Feed of source is refreshed in background after its poll interval (but not sooner
+# than FEED_CACHE_FRESH_TIME), until then stale record is shown. Record is kept for FEED_CACHE_TIME, after that feed is
+# downloaded during request. Only one refresh of a feed runs in FEED_REFRESH_LOCK_TIME
+
+FEED_CACHE_FRESH_TIME = 5 * 60
+FEED_CACHE_TIME = 24 * 60 * 60
+FEED_REFRESH_LOCK_TIME = 2 * 60
+
+# Poll interval of every source adapts to how often its feed changes, within these
+# bounds (seconds), failing sources are retried after exponentially growing time
+
+FEED_MIN_POLL_INTERVAL = 5 * 60
+FEED_MAX_POLL_INTERVAL = 24 * 60 * 60
+
+# When feeds missing in cache are not downloaded during request, category page is sent
+# right away and articles of these feeds are added by the browser as they arrive
+
+FEED_STREAMING = True
+
+# How long (seconds) host of article behind feedproxy/rss redirect is remembered
+
+FEED_REDIRECT_CACHE_TIME = 30 * 24 * 60 * 60
+
+# How long (seconds) feeds found on website by FindSourcesView are remembered
+
+FEED_DISCOVERY_CACHE_TIME = 24 * 60 * 60
+
+# Changes which articles not matching category tags are shown
+
+FEED_SAMPLING_SEED = ''
+
 # Internationalization
 # https://docs.djangoproject.com/en/3.0/topics/i18n/
 
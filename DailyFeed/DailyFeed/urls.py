@@ -15,7 +15,6 @@ Including another URLconf
 """
 from django.contrib import admin
 from django.urls import path
-from django.views.decorators.cache import cache_page
 import sys
 sys.path.append("..")
 from feed import views
@@ -24,12 +23,21 @@ urlpatterns = [
     path('admin/', admin.site.urls),
     path('', views.IndexView.as_view(), name='index'),
     path('category/<int:id>', views.CategoryView.as_view(), name='category-view'),
+    path('category/<int:id>/stream', views.CategoryStreamView.as_view(), name='category-stream'),
+    path('category/<int:id>/search', views.SearchView.as_view(), name='category-search'),
+    path('search', views.SearchView.as_view(), name='search'),
     path('category/new', views.CategoryCreateView.as_view(), name="new-category"),
     path('category/<int:id>/source', views.CategorySourcesView.as_view(), name='category-sources'),
     path("category/<int:id>/source/new", views.SourceCreateView.as_view(), name="new-source"),
+    path("category/<int:category_id>/source/<int:pk>/delete", views.RemoveCategorySourceView.as_view(),
+         name="remove-category-source"),
     path("category/<int:id>/tags/new", views.TagCreateView.as_view(), name="new-category-tag"),
     path("category/<int:category_id>/tags/<int:pk>/delete", views.DeleteTagView.as_view(), name="delete-tag"),
     path("source/check", views.FindSourcesView.as_view() , name="find-source"),
     path("source/check/add", views.AddDiscoveredSourceView.as_view(), name="discovered-source-add"),
-    path("source/<int:pk>/delete", views.DeleteSourceView.as_view(), name="delete-source")
+    path("source/<int:pk>/delete", views.DeleteSourceView.as_view(), name="delete-source"),
+    path("source/opml", views.OpmlImportView.as_view(), name="opml-import"),
+    path("source/opml/export", views.opml_export_view, name="opml-export"),
+    path("metrics", views.metrics_view, name="metrics"),
+    path("api/category/<int:id>/articles", views.category_articles_api, name="api-category-articles")
 ]
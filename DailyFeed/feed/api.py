@@ -0,0 +1,73 @@
+import datetime
+import hashlib
+
+from django.db.models import Max, Q
+
+from .feed_cache import get_versions, page_version_key
+from .models import CategoryArticle
+
+default_page_size = 50
+max_page_size = 100
+epoch = datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc)
+
+
+def encode_cursor(published, category_article_id):
+    """Cursor points at the last article of page, next page starts right after it"""
+    return "{}.{}".format((published - epoch) // datetime.timedelta(microseconds=1), category_article_id)
+
+
+def decode_cursor(cursor):
+    """:returns
+    (published, id) of the last article of previous page, ValueError when cursor is not valid"""
+    microseconds, _, category_article_id = cursor.partition('.')
+    try:
+        return epoch + datetime.timedelta(microseconds=int(microseconds)), int(category_article_id)
+    except OverflowError:
+        raise ValueError("Cursor out of range: {}".format(cursor))
+
+
+def articles_etag(category_id, query):
+    """ETag of API response, made of page version of category, which is bumped whenever articles
+    of category are saved (see ingest.store_articles) or deleted with its sources,
+    so checking unchanged response costs single cache read"""
+    version_key = page_version_key(category_id)
+    digest = hashlib.md5("{}.{}".format(get_versions([version_key])[version_key], query).encode('utf-8')).hexdigest()
+    return '"{}"'.format(digest)
+
+
+def newest_article_id(category_id):
+    """Returns id of the newest saved article of category, for polling with since"""
+    return CategoryArticle.objects.filter(category_id=category_id).aggregate(last_id=Max('id'))['last_id'] or 0
+
+
+def get_articles_page(category_id, cursor=None, since=0, limit=default_page_size):
+    """Returns page of articles of category saved by ingest_feeds, newest first. Pages are
+    read with keyset on (published, id), so deep pages cost as much as the first one
+    :argument
+    cursor - page starts after article of this cursor, see encode_cursor
+    since - only articles saved after the one with this id, see newest_article_id
+    :returns
+    (list of article dictionaries, cursor of the next page or None when it is the last page)"""
+    category_articles = CategoryArticle.objects.filter(category_id=category_id)
+    if since:
+        category_articles = category_articles.filter(id__gt=since)
+    if cursor:
+        published, category_article_id = decode_cursor(cursor)
+        category_articles = category_articles.filter(
+            Q(published__lt=published) | Q(published=published, id__lt=category_article_id)
+        )
+    rows = list(category_articles.order_by('-published', '-id').values(
+        'id', 'published', 'relevance', 'article_id', 'article__url', 'article__title',
+        'article__summary', 'article__website'
+    )[:limit + 1])
+    next_cursor = encode_cursor(rows[limit - 1]['published'], rows[limit - 1]['id']) if len(rows) > limit else None
+    articles = [
+        {'id': row['article_id'],
+         'url': row['article__url'],
+         'title': row['article__title'],
+         'summary': row['article__summary'],
+         'website': row['article__website'],
+         'published': row['published'].isoformat(),
+         'relevance': row['relevance']
+         } for row in rows[:limit]]
+    return articles, next_cursor
@@ -0,0 +1,179 @@
+import asyncio
+import logging
+from functools import partial
+
+from asgiref.sync import sync_to_async
+from django.core import signals
+from django.core.handlers.asgi import ASGIHandler
+from django.core.exceptions import RequestAborted
+from django.http import FileResponse
+from django.middleware.csrf import CsrfViewMiddleware
+from django.urls import resolve, set_script_prefix, Resolver404
+
+from . import async_fetcher
+from .async_fetcher import cache_sync_to_async
+from .feed_cache import WAIT_TIME, lock_feeds, unlock_feeds, save_feed, check_waiting_feeds, get_page
+from .forms import FindSourceForm
+from .scheduler import record_attempts
+from .views import CategoryView, CategoryStreamView
+
+logger = logging.getLogger(__name__)
+
+# database connections belong to threads, so code using them always runs in the same thread
+database_sync_to_async = partial(sync_to_async, thread_sensitive=True)
+# matching of articles with tags needs no database, it must not wait for database thread
+cpu_sync_to_async = partial(sync_to_async, thread_sensitive=False)
+
+
+async def iter_build_feeds(view, keys, sources):
+    """Async version of feed_cache.iter_build_feeds with CategoryView.iter_refresh_feeds:
+    feeds locked by this request are downloaded on the event loop (unless other categories
+    did it recently, see shared_feeds) and only building of their records runs in thread,
+    feeds locked by other requests are awaited at most WAIT_TIME. Matcher of view has to be ready,
+    see CategoryView.get_missing_sources
+    :yields
+    (link, FeedRecord) as soon as each record is ready"""
+    links = [site.link for site in sources]
+    own_links = await cache_sync_to_async(lock_feeds)(keys, links)
+    unlocked = set(own_links)
+    try:
+        async for link, shared_feed in async_fetcher.iter_shared_feeds(own_links):
+            record = await cpu_sync_to_async(view.build_record)(link, shared_feed)
+            await cache_sync_to_async(save_feed)(keys, link, record)
+            unlocked.discard(link)
+            yield link, record
+    finally:
+        await cache_sync_to_async(unlock_feeds)(keys, unlocked)
+    await database_sync_to_async(record_attempts)(
+        [site for site in sources if site.link in own_links], set(own_links) - unlocked
+    )
+
+    loop = asyncio.get_running_loop()
+    waiting_links = [link for link in links if link not in own_links]
+    deadline = loop.time() + WAIT_TIME
+    while waiting_links and loop.time() < deadline:
+        records, waiting_links = await cache_sync_to_async(check_waiting_feeds)(keys, waiting_links)
+        for link, record in records.items():
+            yield link, record
+        if waiting_links:
+            await asyncio.sleep(0.1)
+
+
+async def prepare_category(request, id):
+    """Downloads feeds of category missing in cache, so that CategoryView finds all of them,
+    nothing is done when rendered page is cached or in streaming mode, in which the page
+    is sent without missing feeds and CategoryStreamView downloads them"""
+    if CategoryView.streaming or (await cache_sync_to_async(get_page)(id))[1] is not None:
+        return
+    view = CategoryView()
+    view.setup(request, id=id)
+    keys, sources = await database_sync_to_async(view.get_missing_sources)()
+    async for _ in iter_build_feeds(view, keys, sources):
+        pass
+
+
+async def prepare_find_sources(request):
+    """Discovers feeds of posted website for FindSourcesView, see its get_all_rss.
+    Request has to pass CSRF check first, otherwise it is left for the middleware to reject"""
+    if CsrfViewMiddleware().process_view(request, None, (), {}) is not None:
+        return
+    form = FindSourceForm(request.POST)
+    if form.is_valid():
+        link = form.cleaned_data.get('link')
+        request.discovered_feeds = {link: await async_fetcher.discover_feeds(link)}
+
+
+async def stream_category(request, send, id):
+    """Async version of CategoryStreamView"""
+    view = CategoryStreamView()
+    view.setup(request, id=id)
+    keys, sources, new_entries = await database_sync_to_async(view.get_stream_state)()
+    await send({
+        'type': 'http.response.start',
+        'status': 200,
+        'headers': [(b'Content-Type', b'text/event-stream'), (b'Cache-Control', b'no-cache'),
+                    (b'X-Accel-Buffering', b'no')],
+    })
+    if new_entries:
+        await send_event(send, view.event('articles', view.newest_articles(new_entries)))
+    async for link, record in iter_build_feeds(view, keys, sources):
+        if record.entries:
+            await send_event(send, view.event('articles', view.newest_articles([record.entries])))
+    await send_event(send, view.event('done', []))
+    await send({'type': 'http.response.body'})
+
+
+async def wait_for_disconnect(receive):
+    while (await receive())['type'] != 'http.disconnect':
+        pass
+
+
+async def run_until_disconnect(coroutine, receive):
+    """Runs coroutine until it finishes or client disconnects, then it is cancelled,
+    so that downloads of feeds nobody waits for any more stop right away"""
+    task = asyncio.ensure_future(coroutine)
+    disconnect = asyncio.ensure_future(wait_for_disconnect(receive))
+    try:
+        await asyncio.wait([task, disconnect], return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        disconnect.cancel()
+        task.cancel()
+        # cancelled stream still releases locks of its feeds
+        await asyncio.gather(task, disconnect, return_exceptions=True)
+    if not task.cancelled():
+        task.result()
+
+
+async def send_event(send, event):
+    await send({'type': 'http.response.body', 'body': event.encode('utf-8'), 'more_body': True})
+
+
+class FeedASGIHandler(ASGIHandler):
+    """ASGI handler which waits for upstream feeds on the event loop instead of worker threads.
+    Feeds of category page missing in cache (unless FEED_STREAMING is on) and feeds of website
+    posted to FindSourcesView are downloaded with async_fetcher before the request goes through
+    middleware and the view, which then find them ready. Stream of category is served by the event loop entirely,
+    its downloads are cancelled when client disconnects.
+    Other requests are handled like by ASGIHandler"""
+    prepare_views = {
+        ('GET', 'category-view'): prepare_category,
+        ('POST', 'find-source'): prepare_find_sources,
+    }
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            raise ValueError('Django can only handle ASGI/HTTP connections, not %s.' % scope['type'])
+        try:
+            body_file = await self.read_body(receive)
+        except RequestAborted:
+            return
+        set_script_prefix(self.get_script_prefix(scope))
+        await sync_to_async(signals.request_started.send)(sender=self.__class__, scope=scope)
+        request, error_response = self.create_request(scope, body_file)
+        if request is None:
+            await self.send_response(error_response, send)
+            return
+
+        try:
+            match = resolve(request.path_info)
+        except Resolver404:
+            match = None
+        if match and request.method == 'GET' and match.url_name == 'category-stream':
+            try:
+                await run_until_disconnect(stream_category(request, send, **match.kwargs), receive)
+            finally:
+                await sync_to_async(signals.request_finished.send)(sender=self.__class__)
+            return
+        prepare = self.prepare_views.get((request.method, match.url_name)) if match else None
+        if prepare:
+            try:
+                await prepare(request, **match.kwargs)
+            except Exception:
+                # view does the work itself then
+                logger.exception("Preparing of %s failed", request.path)
+
+        response = await sync_to_async(self.get_response)(request)
+        response._handler_class = self.__class__
+        if isinstance(response, FileResponse):
+            response.block_size = self.chunk_size
+        await self.send_response(response, send)
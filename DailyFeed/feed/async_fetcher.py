@@ -0,0 +1,171 @@
+"""Asyncio versions of fetcher and discovery functions, used by FeedASGIHandler, so that
+waiting for upstream feeds does not hold a worker thread. Requests are sent by httpx client
+with connection pool shared by all requests of the event loop"""
+import asyncio
+import logging
+import time
+import weakref
+from functools import partial
+from urllib.parse import urlsplit
+
+import feedparser
+import httpx
+from asgiref.sync import sync_to_async
+from django.core.cache import cache
+
+from .fetcher import FETCH_TIMEOUT, FETCH_WORKERS, FETCH_PER_HOST, validator_headers, parse_response, \
+    report_unfinished, report_failure, remaining_time
+from .discovery import DISCOVERY_CACHE_TIME, max_candidates, sniff_headers, discovery_key, probe_links, \
+    unvalidated_links, valid_feeds, FeedLinkParser, FeedSniffer
+from .metrics import timed
+from .shared_feeds import read_shared_feeds, store_shared_feed, validators_of
+
+logger = logging.getLogger(__name__)
+
+user_agent = feedparser.USER_AGENT
+max_redirects = 5
+
+# cache requests (and HEAD requests resolving websites of shared feeds) need no database connection,
+# so they must not wait in the single database thread
+cache_sync_to_async = partial(sync_to_async, thread_sensitive=False)
+
+_clients = weakref.WeakKeyDictionary()
+_host_semaphores = weakref.WeakKeyDictionary()
+
+
+def get_client():
+    """Returns httpx client of the running event loop, idle keep-alive connections of every host
+    are kept for the next requests. Proxies are read from HTTP_PROXY and HTTPS_PROXY, like by requests.
+    Requests have no timeout of their own, callers limit them with asyncio.wait_for"""
+    loop = asyncio.get_running_loop()
+    if loop not in _clients:
+        _clients[loop] = httpx.AsyncClient(
+            headers={'User-Agent': user_agent},
+            follow_redirects=True,
+            max_redirects=max_redirects,
+            timeout=None,
+            limits=httpx.Limits(max_keepalive_connections=FETCH_WORKERS),
+        )
+    return _clients[loop]
+
+
+def host_semaphore(link):
+    """Limits number of requests sent to one host at once, like fetcher._host_semaphore"""
+    semaphores = _host_semaphores.setdefault(asyncio.get_running_loop(), {})
+    host = urlsplit(link).netloc
+    if host not in semaphores:
+        semaphores[host] = asyncio.Semaphore(FETCH_PER_HOST)
+    return semaphores[host]
+
+
+async def fetch_feed(link, timeout=FETCH_TIMEOUT, etag=None, modified=None):
+    """Same as fetcher.fetch_feed, parsing runs in thread pool, so it does not stop the event loop"""
+    async with host_semaphore(link):
+        with timed('fetch', histogram='feed_source_seconds', source=link):
+            response = await asyncio.wait_for(
+                get_client().get(link, headers=validator_headers(etag, modified)), timeout
+            )
+    return await asyncio.get_running_loop().run_in_executor(
+        None, parse_response, link, response, etag, modified
+    )
+
+
+async def iter_feeds(links, timeout=FETCH_TIMEOUT, validators=None, deadline=None, errors=None):
+    """Same as fetcher.iter_feeds, async generator of (link, parsed feed) in order of completion,
+    feeds not finished in time are cancelled"""
+    validators = validators or {}
+    tasks = {
+        asyncio.ensure_future(fetch_feed(link, timeout, *validators.get(link, (None, None)))): link
+        for link in links
+    }
+    loop = asyncio.get_running_loop()
+    batch_timeout = timeout if deadline is None else deadline
+    end = loop.time() + batch_timeout
+    pending = set(tasks)
+    try:
+        while pending:
+            done, pending = await asyncio.wait(pending, timeout=max(0, end - loop.time()),
+                                               return_when=asyncio.FIRST_COMPLETED)
+            if not done:
+                report_unfinished(fetch_feed.__name__, [tasks[task] for task in pending], batch_timeout)
+                return
+            for task in done:
+                if task.exception() is not None:
+                    report_failure(fetch_feed.__name__, tasks[task], task.exception(), errors)
+                    continue
+                yield tasks[task], task.result()
+    finally:
+        for task in pending:
+            task.cancel()
+
+
+async def fetch_feeds(links, timeout=FETCH_TIMEOUT, validators=None, deadline=None, errors=None):
+    """Same as fetcher.fetch_feeds"""
+    return {link: parsed_feed async for link, parsed_feed in iter_feeds(links, timeout, validators, deadline, errors)}
+
+
+async def find_feed_links(website_link):
+    """Same as discovery.find_feed_links, without timeout, see discover_feeds"""
+    async with get_client().stream('GET', website_link) as response:
+        if response.status_code >= 400:
+            response.raise_for_status()
+        parser = FeedLinkParser(str(response.url))
+        async for chunk in response.aiter_bytes():
+            if parser.feed(chunk):
+                break
+    return parser.links()
+
+
+async def validate_feed(link):
+    """Same as discovery.validate_feed, without timeout, see discover_feeds"""
+    async with get_client().stream('GET', link, headers=sniff_headers) as response:
+        if response.status_code >= 400:
+            return None
+        sniffer = FeedSniffer()
+        async for chunk in response.aiter_bytes():
+            if sniffer.feed(chunk):
+                break
+    return sniffer.feed_url(response.url, response.headers.get('Content-Type', ''))
+
+
+async def discover_feeds(website_link, timeout=FETCH_TIMEOUT):
+    """Same as discovery.discover_feeds, results are shared through the same cache"""
+    key = discovery_key(website_link)
+    feeds = await cache_sync_to_async(cache.get)(key)
+    if feeds is not None:
+        return feeds
+    deadline = time.monotonic() + timeout
+    probes = probe_links(website_link)
+    homepage = asyncio.ensure_future(asyncio.wait_for(find_feed_links(website_link), timeout))
+    validations = {link: asyncio.ensure_future(validate_feed(link)) for link in probes}
+    candidates = None
+    try:
+        candidates = (await homepage)[:max_candidates]
+    except asyncio.TimeoutError:
+        logger.warning("Homepage %s did not load in %s s", website_link, timeout)
+    except Exception as error:
+        logger.warning("Homepage %s failed: %s", website_link, error)
+    for link in unvalidated_links(candidates, validations):
+        validations[link] = asyncio.ensure_future(validate_feed(link))
+    done, pending = await asyncio.wait(validations.values(), timeout=remaining_time(deadline))
+    for task in pending:
+        task.cancel()
+    await asyncio.gather(*pending, return_exceptions=True)
+
+    feeds = valid_feeds((candidates or []) + probes, validations)
+    if candidates is not None:
+        await cache_sync_to_async(cache.set)(key, feeds, DISCOVERY_CACHE_TIME)
+    return feeds
+
+
+async def iter_shared_feeds(links, timeout=FETCH_TIMEOUT):
+    """Same as shared_feeds.iter_shared_feeds"""
+    keys, records, fresh_links = await cache_sync_to_async(read_shared_feeds)(links)
+    for link in fresh_links:
+        yield link, records[link]
+    stale_links = [link for link in links if link not in fresh_links]
+    deadline = time.monotonic() + timeout
+    async for link, parsed_feed in iter_feeds(stale_links, timeout, validators_of(records)):
+        yield link, await cache_sync_to_async(store_shared_feed)(
+            keys, link, parsed_feed, records.get(link), remaining_time(deadline)
+        )
@@ -0,0 +1,219 @@
+"""Benchmark of CategoryView article pipeline, run with `python manage.py benchmark_feeds`.
+Feeds are served from recorded fixtures (fixtures/feeds) by local HTTP servers,
+with configurable latency and share of failing feeds"""
+import math
+import os
+import threading
+import time
+import tracemalloc
+from functools import partial
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from unittest import mock
+
+import feedparser
+from django.core.cache import cache
+from django.db import connection
+from django.test import Client, RequestFactory
+from django.test.utils import CaptureQueriesContext
+
+from .models import Category, Source, SearchTag
+from .source_builder import get_sources
+from .pipeline import parse_entries, find_matching_entries, get_tag_matcher, stable_fraction, article_order, merge_newest
+from .views import CategoryView
+
+fixtures_dir = os.path.join(os.path.dirname(__file__), 'fixtures', 'feeds')
+default_baseline = os.path.join(os.path.dirname(__file__), 'fixtures', 'benchmark_baseline.json')
+
+benchmark_tags = ['python', 'machine learning', 'climate', 'election', 'security']
+
+
+class FeedStandIn:
+    """Local HTTP servers serving fixture feeds. Feed number n is available as /<n>.xml,
+    its content is fixture n % number of fixtures with {source} replaced by source<n>,
+    so every feed has its own articles apart from syndicated ones. Feeds are spread
+    over `hosts` servers on different ports, which count as different hosts for
+    FEED_FETCH_PER_HOST limit
+    :argument
+    latency - seconds each response is delayed
+    failure_rate - share of feeds answering with error 500, always the same feeds for given seed"""
+
+    def __init__(self, hosts=8, latency=0.0, failure_rate=0.0, seed=''):
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.seed = seed
+        self.fixtures = [
+            open(os.path.join(fixtures_dir, name), encoding='utf-8').read()
+            for name in sorted(os.listdir(fixtures_dir)) if name.endswith('.xml')
+        ]
+        self.servers = [ThreadingHTTPServer(('127.0.0.1', 0), self._handler_class()) for _ in range(hosts)]
+        for server in self.servers:
+            server.daemon_threads = True
+
+    def _handler_class(self):
+        stand_in = self
+
+        class FeedHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                time.sleep(stand_in.latency)
+                try:
+                    number = int(self.path.strip('/').split('.')[0])
+                except ValueError:
+                    self.send_error(404)
+                    return
+                if stable_fraction(self.path, stand_in.seed) < stand_in.failure_rate:
+                    self.send_error(500)
+                    return
+                body = stand_in.feed_content(number).encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/xml; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        return FeedHandler
+
+    def feed_content(self, number):
+        return self.fixtures[number % len(self.fixtures)].replace('{source}', 'source{}'.format(number))
+
+    def link(self, number):
+        host, port = self.servers[number % len(self.servers)].server_address
+        return "http://{}:{}/{}.xml".format(host, port, number)
+
+    def start(self):
+        for server in self.servers:
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    def stop(self):
+        for server in self.servers:
+            server.shutdown()
+            server.server_close()
+
+
+def percentile(values, percent):
+    values = sorted(values)
+    return values[max(0, min(len(values) - 1, math.ceil(percent / 100 * len(values)) - 1))]
+
+
+def measure(function, repeat, setup=None):
+    """Runs function repeat times and returns its latency percentiles (seconds), maximal
+    number of database queries and peak of allocated memory (bytes), memory is traced
+    in one additional run, because tracing slows everything down"""
+    latencies = []
+    queries = 0
+    for _ in range(repeat):
+        if setup:
+            setup()
+        with CaptureQueriesContext(connection) as captured:
+            start = time.perf_counter()
+            function()
+            latencies.append(time.perf_counter() - start)
+        queries = max(queries, len(captured))
+    if setup:
+        setup()
+    tracemalloc.start()
+    function()
+    memory_peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return {
+        'p50': round(percentile(latencies, 50), 6),
+        'p90': round(percentile(latencies, 90), 6),
+        'p99': round(percentile(latencies, 99), 6),
+        'memory_peak': memory_peak,
+        'queries': queries
+    }
+
+
+def create_category(stand_in, sources_count):
+    category = Category.objects.create(name="Benchmark {}".format(sources_count))
+    for tag in benchmark_tags:
+        category.search_tags.add(SearchTag.objects.create(name=tag))
+    links = [stand_in.link(number) for number in range(sources_count)]
+    # sources of smaller runs are shared, like sources of categories subscribing the same feeds
+    category.sources.add(*get_sources({link: link for link in links}).values())
+    return category
+
+
+def clear_feeds():
+    """Setup of cold runs: empties cache and forgets failures of feeds, so that every
+    run downloads the same feeds"""
+    cache.clear()
+    Source.objects.update(failures=0, next_poll=None)
+
+
+def get_articles(category_id):
+    """Builds articles of category waiting for all feeds, like CategoryView without streaming"""
+    view = CategoryView()
+    view.streaming = False
+    view.setup(RequestFactory().get('/category/{}'.format(category_id)), id=category_id)
+    return view.get_articles(view.category)
+
+
+def render_category(client, category_id):
+    """Renders page of category waiting for all feeds, streaming would render only the page
+    without articles of feeds missing in cache"""
+    with mock.patch.object(CategoryView, 'streaming', False):
+        return client.get('/category/{}'.format(category_id))
+
+
+def get_first_streamed_articles(client, category_id):
+    """Reads stream of category until first articles arrive, i.e. time to first article
+    of page with cold cache (page itself does not wait for feeds)"""
+    response = client.get('/category/{}/stream'.format(category_id))
+    try:
+        for event in response.streaming_content:
+            if event.startswith(b'event: articles'):
+                return event
+    finally:
+        response.close()
+
+
+def run_benchmarks(stand_in, sources_counts, repeat):
+    """Returns dictionary {scenario: {number of sources: measurements}}, see measure"""
+    results = {}
+    client = Client()
+    for sources_count in sources_counts:
+        category = create_category(stand_in, sources_count)
+        tag_matcher = get_tag_matcher(benchmark_tags)
+        parsed_feeds = [feedparser.parse(stand_in.feed_content(n)) for n in range(sources_count)]
+        parsed_entries = [parse_entries(parsed_feed) for parsed_feed in parsed_feeds]
+        # own records, matching changes those of parsed_entries in place
+        formatted_feeds = [sorted(parse_entries(parsed_feed), key=article_order, reverse=True)
+                           for parsed_feed in parsed_feeds]
+        scenarios = {
+            'find_matching_entries': (
+                lambda: [find_matching_entries(entries, tag_matcher) for entries in parsed_entries], None),
+            'merge_newest': (lambda: merge_newest(formatted_feeds, 100), None),
+            'get_articles_cold': (partial(get_articles, category.id), clear_feeds),
+            'get_articles_warm': (partial(get_articles, category.id), None),
+            'render_cold': (partial(render_category, client, category.id), clear_feeds),
+            # feeds are cached by render_cold, page too if none of them failed
+            'render_warm': (partial(render_category, client, category.id), None),
+            'stream_first_cold': (partial(get_first_streamed_articles, client, category.id), clear_feeds),
+        }
+        for name, (function, setup) in scenarios.items():
+            results.setdefault(name, {})[str(sources_count)] = measure(function, repeat, setup)
+    return results
+
+
+def find_regressions(results, baseline, tolerance):
+    """Compares results with baseline, latency (p50) and memory may grow by tolerance
+    (0.5 means 50%), number of queries may not grow at all
+    :returns
+    list of descriptions of regressions"""
+    regressions = []
+    for scenario, by_count in results.items():
+        for sources_count, measured in by_count.items():
+            expected = baseline.get(scenario, {}).get(sources_count)
+            if not expected:
+                continue
+            if measured['queries'] > expected['queries']:
+                regressions.append("{} ({} sources): {} queries, baseline {}".format(
+                    scenario, sources_count, measured['queries'], expected['queries']))
+            for metric in ('p50', 'memory_peak'):
+                if measured[metric] > expected[metric] * (1 + tolerance):
+                    regressions.append("{} ({} sources): {} {}, baseline {}".format(
+                        scenario, sources_count, metric, measured[metric], expected[metric]))
+    return regressions
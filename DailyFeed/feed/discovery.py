@@ -0,0 +1,180 @@
+import hashlib
+import logging
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError, wait
+from urllib.parse import urljoin, urlsplit
+
+from django.conf import settings
+from django.core.cache import cache
+from lxml import etree
+
+from .fetcher import session, remaining_time, FETCH_TIMEOUT
+
+logger = logging.getLogger(__name__)
+
+DISCOVERY_CACHE_TIME = getattr(settings, 'FEED_DISCOVERY_CACHE_TIME', 24 * 60 * 60)
+
+feed_types = ('application/rss+xml', 'application/atom+xml', 'application/rdf+xml')
+feed_markers = (b'<rss', b'<feed', b'<rdf:rdf')
+common_feed_paths = ('/feed', '/rss', '/rss.xml', '/atom.xml', '/feed.xml', '/index.xml')
+feed_anchor_regex = re.compile("/(?!.*/).*(rss|xml)")
+max_candidates = 20
+sniffed_bytes = 2048
+sniff_headers = {'Range': 'bytes=0-{}'.format(sniffed_bytes - 1)}
+
+_discovery_executor = ThreadPoolExecutor(max_workers=16, thread_name_prefix='feed-discovery')
+
+
+def discovery_key(website_link):
+    """Feeds are discovered once per host, whichever of its pages was given"""
+    return "discovery_{}".format(hashlib.md5(urlsplit(website_link).netloc.lower().encode('utf-8')).hexdigest())
+
+
+def discover_feeds(website_link, timeout=FETCH_TIMEOUT):
+    """Finds feeds of website: links declared in <head> of homepage (or links to feeds
+    in its body, when there are none) and common feed paths. Homepage and common paths
+    are downloaded at once and every candidate is validated as soon as it is known,
+    results are remembered for DISCOVERY_CACHE_TIME, unless homepage failed. Whole discovery
+    takes at most timeout, candidates not validated by then are skipped
+    :returns
+    list of urls of valid feeds"""
+    key = discovery_key(website_link)
+    feeds = cache.get(key)
+    if feeds is not None:
+        return feeds
+    deadline = time.monotonic() + timeout
+    probes = probe_links(website_link)
+    homepage = _discovery_executor.submit(find_feed_links, website_link, timeout)
+    validations = {link: _discovery_executor.submit(validate_feed, link, timeout) for link in probes}
+    candidates = None
+    try:
+        candidates = homepage.result(timeout)[:max_candidates]
+    except TimeoutError:
+        logger.warning("Homepage %s did not load in %s s", website_link, timeout)
+    except Exception as error:
+        logger.warning("Homepage %s failed: %s", website_link, error)
+    for link in unvalidated_links(candidates, validations):
+        validations[link] = _discovery_executor.submit(validate_feed, link, remaining_time(deadline))
+    wait(validations.values(), remaining_time(deadline))
+    for future in validations.values():
+        future.cancel()
+
+    feeds = valid_feeds((candidates or []) + probes, validations)
+    if candidates is not None:
+        cache.set(key, feeds, DISCOVERY_CACHE_TIME)
+    return feeds
+
+
+def probe_links(website_link):
+    """Returns links of common feed paths of website, validated whatever its homepage declares"""
+    return [urljoin(website_link, path) for path in common_feed_paths]
+
+
+def unvalidated_links(candidates, validations):
+    """Returns candidates found in homepage, which are not validated yet
+    :argument
+    candidates - links found in homepage, None when it failed
+    validations - dictionary {link: future of validate_feed}"""
+    return [link for link in candidates or [] if link not in validations]
+
+
+def valid_feeds(links, validations):
+    """Returns urls of feeds which passed validation, in order of links, without repetitions
+    :argument
+    validations - dictionary {link: finished future of validate_feed}, concurrent or asyncio"""
+    feeds = []
+    for link in links:
+        future = validations[link]
+        if not future.done() or future.cancelled() or future.exception() is not None:
+            continue
+        feed = future.result()
+        if feed and feed not in feeds:
+            feeds.append(feed)
+    return feeds
+
+
+class FeedLinkParser:
+    """Finds links to feeds in homepage fed chunk by chunk, while it is downloaded"""
+
+    def __init__(self, base_url):
+        self.base_url = base_url
+        self.parser = etree.HTMLPullParser(events=('start', 'end'))
+        self.head_links = []
+        self.body_links = []
+
+    def feed(self, chunk):
+        """:returns
+        True when <head> declared feeds, so the rest of the page is not needed"""
+        self.parser.feed(chunk)
+        for event, element in self.parser.read_events():
+            href = element.get('href')
+            if event == 'end':
+                if element.tag == 'head' and self.head_links:
+                    return True
+            elif element.tag == 'link' and href and element.get('type', '').lower() in feed_types:
+                self.head_links.append(urljoin(self.base_url, href))
+            elif element.tag == 'a' and href and feed_anchor_regex.search(href) \
+                    and not any(word in href for word in ('?', 'video', 'script')):
+                self.body_links.append(urljoin(self.base_url, href))
+        return False
+
+    def links(self):
+        return list(dict.fromkeys(self.head_links + self.body_links))
+
+
+def find_feed_links(website_link, timeout=FETCH_TIMEOUT):
+    """Returns links to feeds found in homepage, which is parsed while it is downloaded.
+    When <head> declares feeds (<link type="application/rss+xml">), the rest of the page
+    is not downloaded, otherwise links in body which look like feeds are returned"""
+    response = session.get(website_link, timeout=timeout, stream=True)
+    try:
+        response.raise_for_status()
+        parser = FeedLinkParser(response.url)
+        for chunk in response.iter_content(chunk_size=16384):
+            if parser.feed(chunk):
+                break
+    finally:
+        response.close()
+    return parser.links()
+
+
+def looks_like_feed(content_type, start):
+    """Checks Content-Type header and first bytes of document"""
+    content_type = content_type.split(';')[0].strip().lower()
+    return content_type in feed_types or any(marker in start.lower() for marker in feed_markers)
+
+
+class FeedSniffer:
+    """Collects first bytes of document fed chunk by chunk, enough to tell whether it is a feed"""
+
+    def __init__(self):
+        self.start = b''
+
+    def feed(self, chunk):
+        """:returns
+        True when enough bytes were read, so the rest of the document is not needed"""
+        self.start += chunk
+        return len(self.start) >= sniffed_bytes
+
+    def feed_url(self, url, content_type):
+        """:returns
+        url when document is a feed, None otherwise"""
+        return str(url) if looks_like_feed(content_type, self.start) else None
+
+
+def validate_feed(link, timeout=FETCH_TIMEOUT):
+    """Checks that link leads to a feed, only its first bytes are downloaded
+    :returns
+    url of feed after redirects, None when it is not a feed"""
+    response = session.get(link, timeout=timeout, stream=True, headers=sniff_headers)
+    try:
+        if response.status_code >= 400:
+            return None
+        sniffer = FeedSniffer()
+        for chunk in response.iter_content(chunk_size=sniffed_bytes):
+            if sniffer.feed(chunk):
+                break
+    finally:
+        response.close()
+    return sniffer.feed_url(response.url, response.headers.get('Content-Type', ''))
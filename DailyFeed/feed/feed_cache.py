@@ -0,0 +1,268 @@
+import hashlib
+import logging
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+
+FRESH_TIME = getattr(settings, 'FEED_CACHE_FRESH_TIME', 5 * 60)
+CACHE_TIME = getattr(settings, 'FEED_CACHE_TIME', 24 * 60 * 60)
+REFRESH_LOCK_TIME = getattr(settings, 'FEED_REFRESH_LOCK_TIME', 2 * 60)
+WAIT_TIME = getattr(settings, 'FEED_FETCH_TIMEOUT', 10)
+# changed together with content of FeedRecord, so that records in old format are not read
+RECORD_FORMAT = 3
+
+logger = logging.getLogger(__name__)
+
+_refresh_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix='feed-refresh')
+
+FeedRecord = namedtuple('FeedRecord', ['entries', 'etag', 'modified', 'fetched'])
+FeedRecord.__doc__ = """Feed of single source kept in cache
+entries - ArticleRecord list of articles matching category, ready to be merged: newest first
+etag, modified - validators of the download, conditional requests use those of SharedFeed
+fetched - timestamp of the download, see shared_feeds"""
+
+
+def link_hash(link):
+    return hashlib.md5(link.encode('utf-8')).hexdigest()
+
+
+def category_version_key(category_id):
+    return "version_category_{}".format(category_id)
+
+
+def page_version_key(category_id):
+    return "version_page_{}".format(category_id)
+
+
+# navigation bar of every page lists all categories
+pages_version_key = "version_pages"
+
+
+def source_version_key(link):
+    return "version_source_{}".format(link_hash(link))
+
+
+def get_versions(version_keys):
+    """Reads versions of cache namespaces, namespace without version gets current time
+    in milliseconds, so that it differs from any version used before eviction"""
+    versions = cache.get_many(version_keys)
+    for key in version_keys:
+        if key not in versions:
+            version = int(time.time() * 1000)
+            cache.add(key, version, None)
+            versions[key] = cache.get(key, version)
+    return versions
+
+
+def bump_category_version(category_id):
+    """Makes all cached feeds and rendered page of category unreachable, e.g. after change of its tags"""
+    _bump_version(category_version_key(category_id))
+    bump_page_version(category_id)
+
+
+def bump_page_version(category_id):
+    """Makes rendered page of category unreachable, e.g. after change of its sources or new articles"""
+    _bump_version(page_version_key(category_id))
+
+
+def bump_pages_version():
+    """Makes rendered pages of all categories unreachable, e.g. after new category was created"""
+    _bump_version(pages_version_key)
+
+
+def bump_source_version(link):
+    """Makes cached feed of source unreachable in every category"""
+    _bump_version(source_version_key(link))
+
+
+def bump_versions_on_commit(bump, keys=None):
+    """Calls bump (one of bump_*_version functions) for every one of keys, or once without
+    arguments when keys are None, after current transaction commits. Version bumped before
+    commit could be read by request rendering the page from data before the change,
+    which would be cached with the new version and shown until the next change
+    :argument
+    keys - category ids or links of sources, depending on bump"""
+    if keys is None:
+        transaction.on_commit(bump)
+    else:
+        transaction.on_commit(partial(_bump_versions, bump, list(dict.fromkeys(keys))))
+
+
+def _bump_versions(bump, keys):
+    for key in keys:
+        bump(key)
+
+
+def _bump_version(version_key):
+    try:
+        cache.incr(version_key)
+    except ValueError:
+        # missing version will be created from current time, which is new anyway
+        pass
+
+
+def feed_keys(category_id, links):
+    """Returns dictionary {link: cache key} for feeds of category, keys contain
+    version of category and version of source"""
+    version_keys = [category_version_key(category_id)] + [source_version_key(link) for link in links]
+    versions = get_versions(version_keys)
+    category_version = versions[category_version_key(category_id)]
+    return {
+        link: "feed{}_{}.{}_{}.{}".format(
+            RECORD_FORMAT, category_id, category_version, link_hash(link), versions[source_version_key(link)]
+        ) for link in links
+    }
+
+
+def page_key(category_id):
+    return "page_{}".format(category_id)
+
+
+def get_page(category_id):
+    """Reads rendered page of category with versions it depends on, with single cache request
+    :returns
+    (version of page, content of page or None when it has to be rendered again)"""
+    version_keys = [pages_version_key, page_version_key(category_id)]
+    values = cache.get_many(version_keys + [page_key(category_id)])
+    if any(key not in values for key in version_keys):
+        values.update(get_versions(version_keys))
+    version = tuple(values[key] for key in version_keys)
+    page = values.get(page_key(category_id))
+    return version, page[1] if page is not None and page[0] == version else None
+
+
+def set_page(category_id, version, content, timeout):
+    """Saves rendered page of category, version is the one returned by get_page before rendering,
+    so page rendered while its dependencies changed is not read"""
+    cache.set(page_key(category_id), (version, content), timeout)
+
+
+def lock_key(key):
+    return "lock_{}".format(key)
+
+
+def lock_feeds(keys, links):
+    """Locks feeds with cache.add for REFRESH_LOCK_TIME, so only one request (in any process)
+    downloads each of them
+    :returns
+    links locked by this call"""
+    return [link for link in links if cache.add(lock_key(keys[link]), True, REFRESH_LOCK_TIME)]
+
+
+def unlock_feeds(keys, links):
+    cache.delete_many([lock_key(keys[link]) for link in links])
+
+
+def save_feed(keys, link, record):
+    """Saves record of feed built under lock and releases the lock"""
+    cache.set(keys[link], record, CACHE_TIME)
+    cache.delete(lock_key(keys[link]))
+
+
+def check_waiting_feeds(keys, links):
+    """Checks feeds locked by other requests
+    :returns
+    (dictionary {link: FeedRecord} of feeds built meanwhile, links still locked)"""
+    records = get_feeds({link: keys[link] for link in links})
+    locks = cache.get_many([lock_key(keys[link]) for link in links])
+    # lock released without record means that download of the feed failed
+    return records, [link for link in links if link not in records and lock_key(keys[link]) in locks]
+
+
+def is_fresh(record, now=None, fresh_time=FRESH_TIME):
+    """fresh_time - seconds after download after which record is stale, e.g. poll interval of the source"""
+    return (now or time.time()) - record.fetched < fresh_time
+
+
+def get_feeds(keys):
+    """Reads records of many feeds with single cache request
+    :argument
+    keys - dictionary {link: cache key}, see feed_keys
+    :returns
+    dictionary {link: FeedRecord} for links which are in cache, fresh or not"""
+    links = {key: link for link, key in keys.items()}
+    return {links[key]: record for key, record in cache.get_many(list(links)).items()}
+
+
+def set_feeds(keys, records):
+    """Saves dictionary {link: FeedRecord} with single cache request. Records are kept
+    for CACHE_TIME, after FRESH_TIME they are still shown, but refreshed in background"""
+    cache.set_many({keys[link]: record for link, record in records.items()}, CACHE_TIME)
+
+
+def build_feeds(keys, links, build):
+    """Builds records of feeds missing in cache. Feed is locked with cache.add, so when
+    many requests miss the same feed at once, only one downloads it and others wait
+    for its record, at most WAIT_TIME
+    :argument
+    keys - dictionary {link: cache key}, see feed_keys
+    links - links of missing feeds
+    build - function taking list of links and returning dictionary {link: FeedRecord}
+    :returns
+    dictionary {link: FeedRecord} of built feeds"""
+    return dict(iter_build_feeds(keys, links, lambda own_links: build(own_links).items()))
+
+
+def iter_build_feeds(keys, links, build):
+    """Same as build_feeds, but yields (link, FeedRecord) as soon as each record is ready,
+    every record is saved and its lock released right away
+    :argument
+    build - function taking list of links and yielding (link, FeedRecord)"""
+    own_links = lock_feeds(keys, links)
+    unlocked = set(own_links)
+    try:
+        if own_links:
+            for link, record in build(own_links):
+                save_feed(keys, link, record)
+                unlocked.discard(link)
+                yield link, record
+    finally:
+        unlock_feeds(keys, unlocked)
+
+    waiting_links = [link for link in links if link not in own_links]
+    deadline = time.time() + WAIT_TIME
+    while waiting_links and time.time() < deadline:
+        records, waiting_links = check_waiting_feeds(keys, waiting_links)
+        yield from records.items()
+        if waiting_links:
+            time.sleep(0.1)
+
+
+def refresh_in_background(keys, links, refresh, record=None):
+    """Runs refresh for stale feeds in background thread, so that request can be answered
+    with stale records right away. Feed is locked with cache.add for REFRESH_LOCK_TIME,
+    so only one request (in any process) refreshes it
+    :argument
+    keys - dictionary {link: cache key}, see feed_keys
+    links - links of stale feeds
+    refresh - function taking list of links and returning dictionary {link: FeedRecord},
+    it must not use database
+    record - function taking refreshed links and dictionary {link: FeedRecord} of those
+    refreshed successfully, called in background thread after refresh, also when it failed
+    :returns
+    links for which refresh was started"""
+    locked_links = lock_feeds(keys, links)
+    if locked_links:
+        _refresh_executor.submit(_refresh, keys, locked_links, refresh, record)
+    return locked_links
+
+
+def _refresh(keys, links, refresh, record):
+    records = {}
+    try:
+        records = refresh(links)
+        set_feeds(keys, records)
+    except Exception:
+        logger.exception("Background refresh of %s failed", links)
+    finally:
+        unlock_feeds(keys, links)
+    if record:
+        try:
+            record(links, records)
+        except Exception:
+            logger.exception("Recording background refresh of %s failed", links)
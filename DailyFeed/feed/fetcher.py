@@ -0,0 +1,283 @@
+import hashlib
+import logging
+import math
+import sys
+import threading
+import time
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from urllib.parse import urlparse
+
+import feedparser
+import requests
+from requests.adapters import HTTPAdapter
+from django.conf import settings
+from django.core.cache import cache
+
+from .models import Source
+from .metrics import timed, increment
+from .parsing import get_executor, parse_feed
+
+logger = logging.getLogger(__name__)
+
+FETCH_TIMEOUT = getattr(settings, 'FEED_FETCH_TIMEOUT', 10)
+FETCH_WORKERS = getattr(settings, 'FEED_FETCH_WORKERS', 16)
+FETCH_PER_HOST = getattr(settings, 'FEED_FETCH_PER_HOST', 2)
+REDIRECT_CACHE_TIME = getattr(settings, 'FEED_REDIRECT_CACHE_TIME', 30 * 24 * 60 * 60)
+
+redirecting_websites = ('feedproxy', 'rss')
+chunk_size = 16384
+host_poll_time = 0.05
+
+session = requests.Session()
+session.max_redirects = 5
+session.mount('http://', HTTPAdapter(pool_connections=FETCH_WORKERS, pool_maxsize=FETCH_WORKERS))
+session.mount('https://', HTTPAdapter(pool_connections=FETCH_WORKERS, pool_maxsize=FETCH_WORKERS))
+
+_executor = ThreadPoolExecutor(max_workers=FETCH_WORKERS, thread_name_prefix='feed-fetch')
+_host_semaphores = {}
+_host_semaphores_lock = threading.Lock()
+
+
+def _host_semaphore(link):
+    host = urlparse(link).netloc
+    with _host_semaphores_lock:
+        if host not in _host_semaphores:
+            _host_semaphores[host] = threading.BoundedSemaphore(FETCH_PER_HOST)
+        return _host_semaphores[host]
+
+
+def fetch_feed(link, timeout=FETCH_TIMEOUT, etag=None, modified=None, tag_sets=None):
+    """Downloads and parses single RSS/Atom feed, at most FETCH_PER_HOST requests
+    are sent to the same host at once
+    :argument
+    link - url of the feed
+    timeout - seconds after which download is abandoned
+    etag, modified - ETag and Last-Modified headers from previous fetch, when feed
+    did not change server answers 304 and nothing is parsed
+    tag_sets - categories in which articles are matched, see parsing.parse_feed
+    :returns
+    compact parsed feed, as returned by parsing.parse_feed, with status, etag and modified set,
+    for status 304 entries and articles are empty"""
+    with _host_semaphore(link):
+        return _fetch_feed(link, timeout, etag, modified, tag_sets)
+
+
+def _fetch_feed(link, timeout=FETCH_TIMEOUT, etag=None, modified=None, tag_sets=None):
+    """fetch_feed without limit of requests per host, _iter_concurrently applies it"""
+    with timed('fetch', histogram='feed_source_seconds', source=link):
+        response = download(link, timeout, validator_headers(etag, modified))
+    return parse_response(link, response, etag, modified, tag_sets)
+
+
+def download(url, timeout=FETCH_TIMEOUT, headers=None):
+    """GET of url which takes at most timeout seconds as a whole: timeout of requests limits
+    single socket operations only, so server sending feed slowly could hold it much longer.
+    Reading stops at most one socket timeout after the deadline
+    :returns
+    response of requests with content read"""
+    deadline = time.monotonic() + timeout
+    response = session.get(url, timeout=timeout, headers=headers, stream=True)
+    try:
+        chunks = []
+        for chunk in response.iter_content(chunk_size):
+            chunks.append(chunk)
+            if time.monotonic() > deadline:
+                raise requests.exceptions.Timeout("Download of {} took more than {} s".format(url, timeout))
+        response._content = b''.join(chunks)
+        # connection goes back to the pool
+        response._content_consumed = True
+    finally:
+        response.close()
+    return response
+
+
+def validator_headers(etag=None, modified=None):
+    headers = {}
+    if etag:
+        headers['If-None-Match'] = etag
+    if modified:
+        headers['If-Modified-Since'] = modified
+    return headers
+
+
+def parse_response(link, response, etag=None, modified=None, tag_sets=None):
+    """Parses downloaded feed in executor of FEED_PARSE_BACKEND, see fetch_feed
+    :argument
+    response - response of requests or httpx, with status_code, url, headers and content"""
+    increment('feed_fetch_total', source=link, status=response.status_code)
+    # httpx raises for 304 as well
+    if response.status_code >= 400:
+        response.raise_for_status()
+    if response.status_code == 304:
+        parsed_feed = feedparser.FeedParserDict(
+            entries=[], feed=feedparser.FeedParserDict(), headers=dict(response.headers), articles=[], matches={}
+        )
+    else:
+        with timed('parse', histogram='feed_source_seconds', source=link):
+            parsed_feed = get_executor().submit(
+                parse_feed, response.content, dict(response.headers), str(response.url), tag_sets
+            ).result()
+    parsed_feed['status'] = response.status_code
+    parsed_feed['href'] = str(response.url)
+    parsed_feed['etag'] = response.headers.get('ETag', etag or '')
+    parsed_feed['modified'] = response.headers.get('Last-Modified', modified or '')
+    return parsed_feed
+
+
+def _iter_concurrently(function, arguments, timeout, errors=None):
+    """Runs function for each of arguments in shared thread pool and yields results
+    as soon as they are ready, for at most timeout seconds. Keys are urls, call waits
+    for free slot of its host (see _host_semaphore) before it is submitted, so that
+    host with many feeds does not hold workers of the pool. Calls which did not start
+    in time, or when caller stops reading, are cancelled
+    :argument
+    arguments - dictionary {url: tuple of function arguments}
+    errors - optional dictionary, filled with {url: exception} of failed calls
+    :yields
+    (key, result) for calls which succeeded in time, in order of completion"""
+    waiting = {}
+    for key in arguments:
+        waiting.setdefault(urlparse(key).netloc, deque()).append(key)
+    futures = {}
+    deadline = time.monotonic() + timeout
+    try:
+        while waiting or futures:
+            for host in list(waiting):
+                keys = waiting[host]
+                semaphore = _host_semaphore(keys[0])
+                while keys and semaphore.acquire(blocking=False):
+                    future = _executor.submit(function, *arguments[keys[0]])
+                    future.add_done_callback(lambda _, semaphore=semaphore: semaphore.release())
+                    futures[future] = keys.popleft()
+                if not keys:
+                    del waiting[host]
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                report_unfinished(function.__name__, list(futures.values()) + [
+                    key for keys in waiting.values() for key in keys
+                ], timeout)
+                return
+            # hosts busy with other requests are checked again soon
+            wait_time = min(remaining, host_poll_time) if waiting else remaining
+            if not futures:
+                time.sleep(wait_time)
+                continue
+            done, _ = wait(futures, timeout=wait_time, return_when=FIRST_COMPLETED)
+            for future in done:
+                key = futures.pop(future)
+                try:
+                    result = future.result()
+                except Exception as error:
+                    report_failure(function.__name__, key, error, errors)
+                    continue
+                yield key, result
+    finally:
+        for future in futures:
+            future.cancel()
+
+
+def remaining_time(deadline):
+    """Returns seconds left until deadline of time.monotonic, 0 when it passed"""
+    return max(0, deadline - time.monotonic())
+
+
+def report_unfinished(name, keys, timeout):
+    """Logs calls of concurrent batch which did not finish in time, see _iter_concurrently"""
+    for key in keys:
+        logger.warning("%s for %s did not finish in %s s", name, key, timeout)
+
+
+def report_failure(name, key, error, errors=None):
+    """Logs failed call of concurrent batch and adds it to errors, see _iter_concurrently"""
+    logger.warning("%s failed for %s: %s", name, key, error)
+    if errors is not None:
+        errors[key] = error
+
+
+def _run_concurrently(function, arguments, timeout, errors=None):
+    """Same as _iter_concurrently, but waits for all results
+    :returns
+    dictionary {key: result} for calls which succeeded in time"""
+    return dict(_iter_concurrently(function, arguments, timeout, errors))
+
+
+def iter_feeds(links, timeout=FETCH_TIMEOUT, validators=None, deadline=None, tag_sets=None, errors=None):
+    """Fetches many feeds concurrently, like fetch_feeds, but yields (link, parsed feed)
+    as soon as each feed is ready, so the fastest feeds can be shown first"""
+    validators = validators or {}
+    tag_sets = tag_sets or {}
+    return _iter_concurrently(
+        _fetch_feed,
+        {link: (link, timeout) + tuple(validators.get(link, (None, None))) + (tag_sets.get(link),) for link in links},
+        timeout if deadline is None else deadline,
+        errors
+    )
+
+
+def batch_deadline(links, timeout=FETCH_TIMEOUT):
+    """Returns seconds in which batch of links is fetched even when every feed takes the whole
+    timeout, FETCH_WORKERS feeds are fetched at once, at most FETCH_PER_HOST of each host"""
+    hosts = Counter(urlparse(link).netloc for link in links)
+    rounds = max([math.ceil(len(links) / FETCH_WORKERS)] +
+                 [math.ceil(count / FETCH_PER_HOST) for count in hosts.values()], default=1)
+    return timeout * max(1, rounds)
+
+
+def fetch_feeds(links, timeout=FETCH_TIMEOUT, validators=None, deadline=None, tag_sets=None, errors=None):
+    """Fetches many feeds concurrently. Feeds which failed or did not finish in time
+    are skipped, so one dead source costs at most the timeout
+    :argument
+    links - iterable of feed urls
+    timeout - timeout in seconds for single feed and, unless deadline is given, for the whole batch
+    validators - optional dictionary {link: (etag, modified)} used for conditional requests
+    deadline - seconds for the whole batch, for batches too big to be fetched in timeout
+    tag_sets - optional dictionary {link: tag sets of categories}, see parsing.parse_feed
+    errors - optional dictionary, filled with {link: exception} of feeds which failed,
+    feeds missing in both results and errors did not finish in time
+    :returns
+    dictionary {link: parsed feed} with successfully fetched feeds only"""
+    return dict(iter_feeds(links, timeout, validators, deadline, tag_sets, errors))
+
+
+def resolve_host(url, timeout=FETCH_TIMEOUT):
+    """Returns host on which url ends after redirects, only headers are downloaded"""
+    response = session.head(url, allow_redirects=True, timeout=timeout)
+    return urlparse(response.url).netloc
+
+
+def resolve_websites(entries, timeout=FETCH_TIMEOUT):
+    """Replaces website of entries served through feed proxies (feedproxy.google.com, rss.*)
+    with the host on which article really is. Hosts are resolved concurrently
+    and remembered in cache for REDIRECT_CACHE_TIME"""
+    proxied_entries = [
+        e for e in entries
+        if e.website.startswith(redirecting_websites) and e.url.startswith('http')
+    ]
+    keys = {e.url: "host_{}".format(hashlib.md5(e.url.encode('utf-8')).hexdigest()) for e in proxied_entries}
+    cached_hosts = cache.get_many(list(keys.values()))
+    hosts = {url: cached_hosts[key] for url, key in keys.items() if key in cached_hosts}
+    resolved_hosts = _run_concurrently(
+        resolve_host,
+        {url: (url, timeout) for url in keys if url not in hosts},
+        timeout
+    )
+    cache.set_many({keys[url]: host for url, host in resolved_hosts.items()}, REDIRECT_CACHE_TIME)
+    hosts.update(resolved_hosts)
+    for entry in proxied_entries:
+        entry.website = sys.intern(hosts.get(entry.url, entry.website))
+    return entries
+
+
+def save_validators(sources, fetched_feeds):
+    """Remembers ETag and Last-Modified of fetched feeds in their sources"""
+    changed_sources = []
+    for source in sources:
+        parsed_feed = fetched_feeds.get(source.link)
+        if parsed_feed is None:
+            continue
+        validators = (parsed_feed.get('etag', ''), parsed_feed.get('modified', ''))
+        if validators != (source.etag, source.last_modified):
+            source.etag, source.last_modified = validators
+            changed_sources.append(source)
+    Source.objects.bulk_update(changed_sources, ['etag', 'last_modified'])
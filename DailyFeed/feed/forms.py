@@ -6,7 +6,7 @@ class SourceForm(forms.ModelForm):
     """Form used when adding new source to news category"""
     class Meta:
         model = Source
-        fields = '__all__'
+        fields = ['name', 'link']
 
 
 class DiscoveredSourceForm(forms.Form):
@@ -48,3 +48,17 @@ class FindSourceForm(forms.Form):
         link: webpage URL
     """
     link = forms.URLField(help_text="Adres strony")
+
+
+class OpmlImportForm(forms.Form):
+    """Form used when importing many sources from OPML file
+    @fields:
+        file: OPML file, exported e.g. from other feed reader
+        category: category for all feeds, when empty feeds go to categories named as their outlines"""
+    file = forms.FileField(label="Plik OPML")
+    category = forms.ModelChoiceField(
+        queryset=Category.objects.all(),
+        required=False,
+        label="Kategoria",
+        help_text="Pozostaw puste, aby dodać feedy do kategorii z pliku"
+    )
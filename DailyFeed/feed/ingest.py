@@ -0,0 +1,131 @@
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from .models import Source, Article, CategoryArticle
+from .feed_cache import bump_page_version, bump_versions_on_commit
+from .fetcher import fetch_feeds, save_validators, resolve_websites, batch_deadline
+from .search import index_articles
+from .scheduler import schedule, scheduling_fields
+from .pipeline import epoch_to_datetime, normalize_url, simhash_to_signed
+
+max_url_length = Article._meta.get_field('normalized_url').max_length
+max_title_length = Article._meta.get_field('title').max_length
+
+
+def get_due_sources(now=None):
+    """Returns sources which were never polled or whose next poll time has come,
+    the longest waiting first"""
+    now = now or timezone.now()
+    return list(
+        Source.objects.filter(Q(next_poll__isnull=True) | Q(next_poll__lte=now))
+        .order_by('next_poll').prefetch_related('category_set__search_tags')
+    )
+
+
+def ingest_sources(sources):
+    """Fetches given sources concurrently, saves their new articles and schedules
+    their next polls, see scheduler.schedule. Articles are matched with categories
+    of the source already by executor which parses the feed, see parsing.parse_feed.
+    Batch gets time to fetch all sources, see fetcher.batch_deadline, sources which still
+    did not finish are left due for the next run, without counting failure
+    :returns
+    number of new articles"""
+    now = timezone.now()
+    links = [source.link for source in sources]
+    errors = {}
+    fetched_feeds = fetch_feeds(
+        links,
+        validators={source.link: (source.etag, source.last_modified) for source in sources},
+        deadline=batch_deadline(links),
+        tag_sets={source.link: {
+            category.id: tuple(t.name for t in category.search_tags.all()) for category in source.category_set.all()
+        } for source in sources},
+        errors=errors
+    )
+    save_validators(sources, fetched_feeds)
+    # websites of all feeds are resolved in one concurrent batch
+    resolve_websites([article for parsed_feed in fetched_feeds.values() for article in parsed_feed.articles])
+    new_articles = 0
+    polled_sources = [source for source in sources if source.link in fetched_feeds or source.link in errors]
+    for source in polled_sources:
+        parsed_feed = fetched_feeds.get(source.link)
+        stored = 0
+        if parsed_feed is not None and parsed_feed.status != 304:
+            if parsed_feed.get('bozo') and not parsed_feed.entries:
+                # broken document counts as failure, so that it is backed off too
+                parsed_feed = None
+            else:
+                stored = store_articles(source, parsed_feed.articles, parsed_feed.matches)
+        schedule(source, parsed_feed, stored > 0, now)
+        new_articles += stored
+    Source.objects.bulk_update(polled_sources, scheduling_fields)
+    return new_articles
+
+
+@transaction.atomic
+def store_articles(source, entries, matches):
+    """Inserts entries which are not in database yet and links entries with categories
+    of the source in which they matched, also entries saved before, e.g. for category
+    which subscribed the source later or from other feed with the same article
+    :argument
+    source - Source instance
+    entries - ArticleRecord list, as returned by parse_entries
+    matches - dictionary {category id: list of (index of entry, relevance)}, see parsing.parse_feed
+    :returns
+    number of new articles"""
+    url_of_entry = {}
+    entries_by_url = {}
+    for entry in entries:
+        normalized_url = normalize_url(entry.url)
+        if entry.url == '----' or len(entry.url) > max_url_length or len(normalized_url) > max_url_length:
+            continue
+        url_of_entry[id(entry)] = normalized_url
+        entries_by_url.setdefault(normalized_url, entry)
+    article_ids = dict(
+        Article.objects.filter(normalized_url__in=entries_by_url).values_list('normalized_url', 'id')
+    )
+    new_entries = {url: entry for url, entry in entries_by_url.items() if url not in article_ids}
+
+    if new_entries:
+        articles = [
+            Article(
+                source=source,
+                url=entry.url,
+                normalized_url=url,
+                title=entry.title[:max_title_length],
+                summary=entry.summary,
+                website=entry.website,
+                published=epoch_to_datetime(entry.published),
+                simhash=simhash_to_signed(entry.simhash)
+            ) for url, entry in new_entries.items()
+        ]
+        Article.objects.bulk_create(articles, ignore_conflicts=True)
+        article_ids.update(
+            Article.objects.filter(normalized_url__in=new_entries).values_list('normalized_url', 'id')
+        )
+        for article in articles:
+            article.id = article_ids[article.normalized_url]
+        index_articles(articles)
+
+    links = {}
+    for category_id, matched in matches.items():
+        for index, relevance in matched:
+            url = url_of_entry.get(id(entries[index]))
+            if url is not None:
+                links.setdefault((category_id, article_ids[url]), (relevance, entries[index].published))
+    if links:
+        existing_links = set(CategoryArticle.objects.filter(
+            category_id__in=matches, article_id__in={article_id for _, article_id in links}
+        ).values_list('category_id', 'article_id'))
+        category_articles = [
+            CategoryArticle(category_id=category_id, article_id=article_id, relevance=relevance,
+                            published=epoch_to_datetime(published))
+            for (category_id, article_id), (relevance, published) in links.items()
+            if (category_id, article_id) not in existing_links
+        ]
+        CategoryArticle.objects.bulk_create(category_articles, ignore_conflicts=True)
+        bump_versions_on_commit(bump_page_version, [
+            category_article.category_id for category_article in category_articles
+        ])
+    return len(new_entries)
@@ -0,0 +1,67 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import override_settings, setup_test_environment, teardown_test_environment
+
+from feed.benchmark import FeedStandIn, run_benchmarks, find_regressions, default_baseline
+
+benchmark_caches = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'benchmark',
+        'OPTIONS': {'MAX_ENTRIES': 100000},
+    }
+}
+
+
+class Command(BaseCommand):
+    help = "Mierzy wydajność pobierania i łączenia artykułów kategorii na lokalnych feedach testowych"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sources', type=int, nargs='+', default=[10, 100, 1000], help="Liczby źródeł w kategorii")
+        parser.add_argument('--repeat', type=int, default=5, help="Liczba powtórzeń każdego pomiaru")
+        parser.add_argument('--latency', type=float, default=20, help="Opóźnienie odpowiedzi feedu w ms")
+        parser.add_argument('--failure-rate', type=float, default=0.05, help="Część feedów odpowiadających błędem")
+        parser.add_argument('--hosts', type=int, default=8, help="Liczba lokalnych serwerów z feedami")
+        parser.add_argument('--baseline', default=default_baseline, help="Plik JSON z wynikami odniesienia")
+        parser.add_argument('--save-baseline', action='store_true', help="Zapisz wyniki jako nowe odniesienie")
+        parser.add_argument('--tolerance', type=float, default=0.5, help="Dopuszczalny wzrost czasu i pamięci (0.5 = 50%%)")
+
+    def handle(self, *args, **options):
+        stand_in = FeedStandIn(hosts=options['hosts'], latency=options['latency'] / 1000,
+                               failure_rate=options['failure_rate'])
+        stand_in.start()
+        setup_test_environment()
+        old_database_name = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        try:
+            with override_settings(CACHES=benchmark_caches):
+                results = run_benchmarks(stand_in, options['sources'], options['repeat'])
+        finally:
+            connection.creation.destroy_test_db(old_database_name, verbosity=0)
+            teardown_test_environment()
+            stand_in.stop()
+
+        self.stdout.write("{:<28}{:>8}{:>10}{:>10}{:>10}{:>12}{:>9}".format(
+            "scenario", "sources", "p50 ms", "p90 ms", "p99 ms", "peak KiB", "queries"))
+        for scenario, by_count in results.items():
+            for sources_count, measured in by_count.items():
+                self.stdout.write("{:<28}{:>8}{:>10.1f}{:>10.1f}{:>10.1f}{:>12.0f}{:>9}".format(
+                    scenario, sources_count, measured['p50'] * 1000, measured['p90'] * 1000,
+                    measured['p99'] * 1000, measured['memory_peak'] / 1024, measured['queries']))
+
+        if options['save_baseline']:
+            with open(options['baseline'], 'w') as baseline_file:
+                json.dump(results, baseline_file, indent=2, sort_keys=True)
+            self.stdout.write("Saved baseline to {}".format(options['baseline']))
+            return
+        try:
+            with open(options['baseline']) as baseline_file:
+                baseline = json.load(baseline_file)
+        except FileNotFoundError:
+            self.stdout.write("No baseline in {}, run with --save-baseline".format(options['baseline']))
+            return
+        regressions = find_regressions(results, baseline, options['tolerance'])
+        if regressions:
+            raise CommandError("Performance regressions:\n" + "\n".join(regressions))
+        self.stdout.write("No regressions against {}".format(options['baseline']))
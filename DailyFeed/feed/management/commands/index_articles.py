@@ -0,0 +1,20 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from feed.models import ArticleTerm
+from feed.search import index_missing_articles
+
+
+class Command(BaseCommand):
+    help = "Dodaje do indeksu wyszukiwania artykuły zapisane przed jego utworzeniem"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rebuild', action='store_true', help="Usuń indeks i zbuduj go od nowa")
+
+    def handle(self, *args, **options):
+        start = time.time()
+        if options['rebuild']:
+            ArticleTerm.objects.all().delete()
+        indexed = index_missing_articles()
+        self.stdout.write("Indexed articles: {}, time: {}s".format(indexed, round(time.time() - start, 3)))
@@ -0,0 +1,31 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from feed.models import Source
+from feed.ingest import get_due_sources, ingest_sources
+
+
+class Command(BaseCommand):
+    help = "Pobiera feedy RSS, których czas odświeżenia minął, i zapisuje nowe artykuły w bazie"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--loop', action='store_true', help="Działaj bez końca, sprawdzając źródła co --sleep sekund")
+        parser.add_argument('--sleep', type=int, default=30, help="Przerwa między sprawdzeniami w trybie --loop")
+        parser.add_argument('--all', action='store_true', help="Pobierz wszystkie źródła, niezależnie od poll_interval")
+
+    def handle(self, *args, **options):
+        while True:
+            if options['all']:
+                sources = list(Source.objects.prefetch_related('category_set__search_tags'))
+            else:
+                sources = get_due_sources()
+            if sources:
+                start = time.time()
+                new_articles = ingest_sources(sources)
+                self.stdout.write("Sources: {}, new articles: {}, time: {}s".format(
+                    len(sources), new_articles, round(time.time() - start, 3)
+                ))
+            if not options['loop']:
+                break
+            time.sleep(options['sleep'])
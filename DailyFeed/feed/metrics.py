@@ -0,0 +1,86 @@
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+histogram_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, float('inf'))
+
+_lock = threading.Lock()
+_counters = {}
+_histograms = {}
+
+request_timings = ContextVar('request_timings', default=None)
+
+
+def _labels_key(labels):
+    return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+
+def increment(name, value=1, **labels):
+    """Increases counter, e.g. increment('feed_cache_total', result='hit')"""
+    key = (name, _labels_key(labels))
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+
+def observe(name, value, **labels):
+    """Adds observation (in seconds) to histogram"""
+    key = (name, _labels_key(labels))
+    with _lock:
+        histogram = _histograms.setdefault(key, {'buckets': [0] * len(histogram_buckets), 'sum': 0.0, 'count': 0})
+        for i, bucket in enumerate(histogram_buckets):
+            if value <= bucket:
+                histogram['buckets'][i] += 1
+        histogram['sum'] += value
+        histogram['count'] += 1
+
+
+@contextmanager
+def timed(stage, histogram='feed_stage_seconds', **labels):
+    """Measures time of pipeline stage, e.g. with timed('sort', category=category_id).
+    Time is added to histogram (stages of single source go to feed_source_seconds)
+    and to Server-Timing header of the current request, see ServerTimingMiddleware"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        duration = time.perf_counter() - start
+        observe(histogram, duration, stage=stage, **labels)
+        add_request_timing(stage, duration)
+
+
+def add_request_timing(stage, duration):
+    timings = request_timings.get()
+    if timings is not None:
+        timings[stage] = timings.get(stage, 0) + duration
+
+
+def _format_labels(labels, **extra):
+    labels = list(labels) + [(key, str(value)) for key, value in extra.items()]
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(key, value.replace('\\', '\\\\').replace('"', '\\"')) for key, value in labels) + '}'
+
+
+def render_metrics():
+    """Returns all metrics of this process in Prometheus text format"""
+    lines = []
+    with _lock:
+        counters = sorted(_counters.items())
+        histograms = sorted((key, dict(value, buckets=list(value['buckets']))) for key, value in _histograms.items())
+    typed = set()
+    for (name, labels), value in counters:
+        if name not in typed:
+            lines.append("# TYPE {} counter".format(name))
+            typed.add(name)
+        lines.append("{}{} {}".format(name, _format_labels(labels), value))
+    for (name, labels), histogram in histograms:
+        if name not in typed:
+            lines.append("# TYPE {} histogram".format(name))
+            typed.add(name)
+        for bucket, count in zip(histogram_buckets, histogram['buckets']):
+            bucket = '+Inf' if bucket == float('inf') else bucket
+            lines.append("{}_bucket{} {}".format(name, _format_labels(labels, le=bucket), count))
+        lines.append("{}_sum{} {}".format(name, _format_labels(labels), round(histogram['sum'], 6)))
+        lines.append("{}_count{} {}".format(name, _format_labels(labels), histogram['count']))
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,37 @@
+import time
+
+from .metrics import request_timings, add_request_timing, observe
+
+
+class ServerTimingMiddleware:
+    """Adds Server-Timing header with durations of feed pipeline stages measured
+    during the request (see metrics.timed), template rendering and whole request"""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        token = request_timings.set({})
+        start = time.perf_counter()
+        try:
+            response = self.get_response(request)
+            timings = request_timings.get()
+        finally:
+            request_timings.reset(token)
+        timings['total'] = time.perf_counter() - start
+        response['Server-Timing'] = ", ".join(
+            "{};dur={:.1f}".format(stage, duration * 1000) for stage, duration in timings.items()
+        )
+        return response
+
+    def process_template_response(self, request, response):
+        start = time.perf_counter()
+        view_name = request.resolver_match.url_name if request.resolver_match else ''
+
+        def measure_render(rendered_response):
+            duration = time.perf_counter() - start
+            observe('feed_stage_seconds', duration, stage='render', view=view_name)
+            add_request_timing('render', duration)
+
+        response.add_post_render_callback(measure_render)
+        return response
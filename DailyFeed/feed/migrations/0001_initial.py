@@ -0,0 +1,121 @@
+# Generated by Django 3.0.3 on 2026-10-18 15:26
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Article',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('url', models.URLField(max_length=512)),
+                ('normalized_url', models.CharField(max_length=512, unique=True)),
+                ('title', models.CharField(max_length=512)),
+                ('summary', models.TextField(blank=True)),
+                ('website', models.CharField(max_length=256)),
+                ('published', models.DateTimeField(db_index=True)),
+                ('simhash', models.BigIntegerField(blank=True, null=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='Category',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=30)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='SearchTag',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=100)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='Source',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=100)),
+                ('link', models.URLField(max_length=256)),
+                ('poll_interval', models.PositiveIntegerField(default=600, help_text='Co ile sekund pobierać feed, dopasowywane do częstości publikacji')),
+                ('last_polled', models.DateTimeField(blank=True, null=True)),
+                ('last_changed', models.DateTimeField(blank=True, null=True)),
+                ('publish_interval', models.PositiveIntegerField(blank=True, help_text='Mediana odstępu między artykułami feedu (sekundy)', null=True)),
+                ('failures', models.PositiveIntegerField(default=0, help_text='Liczba nieudanych pobrań z rzędu')),
+                ('next_poll', models.DateTimeField(blank=True, db_index=True, null=True)),
+                ('etag', models.CharField(blank=True, default='', max_length=256)),
+                ('last_modified', models.CharField(blank=True, default='', max_length=64)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='CategoryArticle',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('relevance', models.FloatField(default=0)),
+                ('published', models.DateTimeField()),
+                ('article', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='feed.Article')),
+                ('category', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='feed.Category')),
+            ],
+        ),
+        migrations.AddField(
+            model_name='category',
+            name='search_tags',
+            field=models.ManyToManyField(to='feed.SearchTag'),
+        ),
+        migrations.AddField(
+            model_name='category',
+            name='sources',
+            field=models.ManyToManyField(to='feed.Source'),
+        ),
+        migrations.CreateModel(
+            name='ArticleTerm',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('term', models.CharField(max_length=64)),
+                ('published', models.DateTimeField()),
+                ('article', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='terms', to='feed.Article')),
+            ],
+        ),
+        migrations.AddField(
+            model_name='article',
+            name='categories',
+            field=models.ManyToManyField(related_name='articles', through='feed.CategoryArticle', to='feed.Category'),
+        ),
+        migrations.AddField(
+            model_name='article',
+            name='source',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='articles', to='feed.Source'),
+        ),
+        migrations.AddIndex(
+            model_name='categoryarticle',
+            index=models.Index(fields=['category', '-published', '-relevance'], name='feed_catego_categor_743ee0_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='categoryarticle',
+            index=models.Index(fields=['category', '-published', '-id'], name='feed_catego_categor_57f425_idx'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='categoryarticle',
+            unique_together={('category', 'article')},
+        ),
+        migrations.AddIndex(
+            model_name='articleterm',
+            index=models.Index(fields=['term', '-published'], name='feed_articl_term_2203b7_idx'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='articleterm',
+            unique_together={('term', 'article')},
+        ),
+        migrations.AddIndex(
+            model_name='article',
+            index=models.Index(fields=['source', '-published'], name='feed_articl_source__920ae0_idx'),
+        ),
+    ]
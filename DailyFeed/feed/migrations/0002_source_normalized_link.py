@@ -0,0 +1,17 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('feed', '0001_initial'),
+    ]
+
+    operations = [
+        # nullable until 0003_merge_duplicate_sources fills it
+        migrations.AddField(
+            model_name='source',
+            name='normalized_link',
+            field=models.CharField(max_length=256, null=True),
+        ),
+    ]
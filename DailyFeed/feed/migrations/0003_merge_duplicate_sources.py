@@ -0,0 +1,19 @@
+from django.db import migrations
+
+
+def merge_duplicate_sources(apps, schema_editor):
+    from feed.source_builder import merge_duplicate_sources
+    merge_duplicate_sources(
+        apps.get_model('feed', 'Source'), apps.get_model('feed', 'Category'), apps.get_model('feed', 'Article')
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('feed', '0002_source_normalized_link'),
+    ]
+
+    operations = [
+        migrations.RunPython(merge_duplicate_sources, migrations.RunPython.noop),
+    ]
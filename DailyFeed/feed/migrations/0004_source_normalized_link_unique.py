@@ -0,0 +1,16 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('feed', '0003_merge_duplicate_sources'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='source',
+            name='normalized_link',
+            field=models.CharField(max_length=256, unique=True),
+        ),
+    ]
@@ -1,4 +1,8 @@
 from django.db import models
+from django.db.models.signals import m2m_changed
+from django.dispatch import receiver
+
+from .pipeline import normalize_url
 
 
 class SearchTag(models.Model):
@@ -11,6 +15,25 @@ class SearchTag(models.Model):
 class Source(models.Model):
     name = models.CharField(max_length=100)
     link = models.URLField(max_length=256)
+    # link after normalize_url, there is one source of every feed, shared by all categories,
+    # sources duplicated before it existed are merged by migration 0003_merge_duplicate_sources
+    normalized_link = models.CharField(max_length=256, unique=True)
+    poll_interval = models.PositiveIntegerField(
+        default=10 * 60, help_text="Co ile sekund pobierać feed, dopasowywane do częstości publikacji"
+    )
+    last_polled = models.DateTimeField(null=True, blank=True)
+    last_changed = models.DateTimeField(null=True, blank=True)
+    publish_interval = models.PositiveIntegerField(
+        null=True, blank=True, help_text="Mediana odstępu między artykułami feedu (sekundy)"
+    )
+    failures = models.PositiveIntegerField(default=0, help_text="Liczba nieudanych pobrań z rzędu")
+    next_poll = models.DateTimeField(null=True, blank=True, db_index=True)
+    etag = models.CharField(max_length=256, blank=True, default='')
+    last_modified = models.CharField(max_length=64, blank=True, default='')
+
+    def save(self, *args, **kwargs):
+        self.normalized_link = normalize_url(self.link)
+        super().save(*args, **kwargs)
 
     def __str__(self):
         return self.link
@@ -24,4 +47,70 @@ class Category(models.Model):
     def __str__(self):
         return self.name
 
-# Create your models here.
+
+class Article(models.Model):
+    """Article saved from RSS feed by ingest_feeds command,
+    categories contains categories in which article matched"""
+    source = models.ForeignKey(Source, on_delete=models.CASCADE, related_name='articles')
+    categories = models.ManyToManyField(Category, related_name='articles', through='CategoryArticle')
+    url = models.URLField(max_length=512)
+    normalized_url = models.CharField(max_length=512, unique=True)
+    title = models.CharField(max_length=512)
+    summary = models.TextField(blank=True)
+    website = models.CharField(max_length=256)
+    published = models.DateTimeField(db_index=True)
+    # SimHash of title and summary computed during ingest, see pipeline.simhash_to_signed
+    simhash = models.BigIntegerField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['source', '-published']),
+        ]
+
+    def __str__(self):
+        return self.title
+
+
+class CategoryArticle(models.Model):
+    """Article matched in category, relevance is computed once during ingest
+    (see pipeline.find_matching_entries), published is copied from article
+    so that newest articles of category can be read from single index"""
+    category = models.ForeignKey(Category, on_delete=models.CASCADE)
+    article = models.ForeignKey(Article, on_delete=models.CASCADE)
+    relevance = models.FloatField(default=0)
+    published = models.DateTimeField()
+
+    class Meta:
+        unique_together = ['category', 'article']
+        indexes = [
+            models.Index(fields=['category', '-published', '-relevance']),
+            # pages of API, see api.get_articles_page
+            models.Index(fields=['category', '-published', '-id']),
+        ]
+
+
+class ArticleTerm(models.Model):
+    """Inverted index of articles: stemmed word of article title or summary
+    (see pipeline.tokenize), published is copied from article, so that newest
+    articles containing the word can be read from single index, see search.py"""
+    term = models.CharField(max_length=64)
+    article = models.ForeignKey(Article, on_delete=models.CASCADE, related_name='terms')
+    published = models.DateTimeField()
+
+    class Meta:
+        unique_together = ['term', 'article']
+        indexes = [
+            models.Index(fields=['term', '-published']),
+        ]
+
+
+def forget_validators(source_ids):
+    """Next poll of sources downloads whole feeds instead of conditional request, so that
+    articles saved before are matched also in categories which subscribed the sources since"""
+    Source.objects.filter(id__in=source_ids).exclude(etag='', last_modified='').update(etag='', last_modified='')
+
+
+@receiver(m2m_changed, sender=Category.sources.through)
+def sources_subscribed(sender, instance, action, reverse, pk_set, **kwargs):
+    if action == 'post_add' and pk_set:
+        forget_validators([instance.pk] if reverse else pk_set)
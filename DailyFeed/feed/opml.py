@@ -0,0 +1,110 @@
+from collections import namedtuple
+
+from django.conf import settings
+from lxml import etree
+
+from .feed_cache import bump_page_version, bump_pages_version, bump_versions_on_commit
+from .fetcher import fetch_feeds
+from .models import Category, Source, forget_validators
+from .source_builder import get_sources
+
+IMPORT_TIMEOUT = getattr(settings, 'FEED_IMPORT_TIMEOUT', 60)
+
+max_name_length = Source._meta.get_field('name').max_length
+max_link_length = Source._meta.get_field('link').max_length
+
+OpmlFeed = namedtuple('OpmlFeed', ['category', 'name', 'link'])
+OpmlFeed.__doc__ = """Feed read from OPML file, category is text of outline containing the feed or None"""
+
+ImportResult = namedtuple('ImportResult', ['added', 'existing', 'failed', 'empty', 'timed_out'])
+ImportResult.__doc__ = """Result of import_feeds: number of sources added to categories,
+number of sources which already were in their categories, links of feeds which could not be fetched,
+links of feeds without articles (often not a feed at all) and links of feeds not fetched before
+IMPORT_TIMEOUT, which may work when imported again"""
+
+
+def parse_opml(content):
+    """Returns list of OpmlFeed with feeds (outlines with xmlUrl) of OPML file,
+    entities are not resolved and nothing is downloaded while parsing
+    :raises
+    ValueError when content is not XML"""
+    parser = etree.XMLParser(resolve_entities=False, no_network=True)
+    try:
+        root = etree.fromstring(content, parser=parser)
+    except etree.XMLSyntaxError as error:
+        raise ValueError(str(error))
+    feeds = []
+    for outline in root.iter('outline'):
+        link = (outline.get('xmlUrl') or '').strip()
+        if not link:
+            continue
+        parent = outline.getparent()
+        category = parent.get('text') or parent.get('title') if parent.tag == 'outline' else None
+        name = outline.get('text') or outline.get('title') or link
+        feeds.append(OpmlFeed(category, name[:max_name_length], link))
+    return feeds
+
+
+def render_opml(categories):
+    """Returns OPML file with one outline for each category, containing its sources
+    :argument
+    categories - categories with prefetched sources"""
+    opml = etree.Element('opml', version='2.0')
+    head = etree.SubElement(opml, 'head')
+    etree.SubElement(head, 'title').text = "DailyFeed"
+    body = etree.SubElement(opml, 'body')
+    for category in categories:
+        category_outline = etree.SubElement(body, 'outline', text=category.name)
+        for source in category.sources.all():
+            etree.SubElement(category_outline, 'outline', type='rss', text=source.name, xmlUrl=source.link)
+    return etree.tostring(opml, xml_declaration=True, encoding='utf-8', pretty_print=True)
+
+
+def import_feeds(feeds, default_category=None):
+    """Adds feeds to categories, feeds are validated concurrently and sources are
+    inserted with bulk_create. Feed goes to default_category, or, when it is not given,
+    to category named as its outline (created when missing)
+    :argument
+    feeds - list of OpmlFeed, see parse_opml
+    :returns
+    ImportResult"""
+    feeds = [feed for feed in feeds if len(feed.link) <= max_link_length and (default_category or feed.category)]
+    links = {feed.link for feed in feeds}
+    errors = {}
+    # feeds not fetched before the deadline are cancelled, see fetcher._iter_concurrently
+    fetched_feeds = fetch_feeds(links, deadline=IMPORT_TIMEOUT, errors=errors)
+    valid_links = {link for link, parsed_feed in fetched_feeds.items() if parsed_feed.entries}
+    empty = sorted(set(fetched_feeds) - valid_links)
+    timed_out = sorted(links - set(fetched_feeds) - set(errors))
+    feeds = [feed for feed in feeds if feed.link in valid_links]
+
+    if default_category:
+        categories = {None: default_category}
+        feeds = [feed._replace(category=None) for feed in feeds]
+    else:
+        names = {feed.category for feed in feeds}
+        categories = {category.name: category for category in Category.objects.filter(name__in=names)}
+        new_names = names - set(categories)
+        for name in new_names:
+            categories[name] = Category.objects.create(name=name)
+        if new_names:
+            bump_versions_on_commit(bump_pages_version)
+
+    names = {}
+    for feed in feeds:
+        names.setdefault(feed.link, feed.name)
+    sources = get_sources(names)
+
+    through = Category.sources.through
+    pairs = {(categories[feed.category].id, sources[feed.link].id) for feed in feeds}
+    existing = set(through.objects.filter(
+        category_id__in={category_id for category_id, _ in pairs},
+        source_id__in={source_id for _, source_id in pairs}
+    ).values_list('category_id', 'source_id'))
+    through.objects.bulk_create([
+        through(category_id=category_id, source_id=source_id) for category_id, source_id in pairs - existing
+    ], ignore_conflicts=True)
+    # bulk_create does not send m2m_changed
+    forget_validators({source_id for _, source_id in pairs - existing})
+    bump_versions_on_commit(bump_page_version, [category_id for category_id, _ in pairs - existing])
+    return ImportResult(len(pairs - existing), len(pairs & existing), sorted(errors), empty, timed_out)
@@ -0,0 +1,87 @@
+"""Parsing of downloaded feeds and matching of their articles with category tags is pure Python
+work bound by GIL, so it runs in executor chosen by FEED_PARSE_BACKEND: 'inline' in the calling
+thread, 'thread' in pool of threads, 'process' in pool of worker processes, which get raw bytes
+of feeds and send back compact ArticleRecord lists, so that parsing of thousands of feeds uses
+all cores. Worker processes import this module only, it must not use models"""
+import os
+import threading
+from concurrent.futures import Executor, Future, ThreadPoolExecutor, ProcessPoolExecutor
+
+import feedparser
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+from .pipeline import parse_entries, find_matching_entries, get_tag_matcher
+
+PARSE_BACKEND = getattr(settings, 'FEED_PARSE_BACKEND', 'inline')
+PARSE_WORKERS = getattr(settings, 'FEED_PARSE_WORKERS', None) or os.cpu_count()
+SAMPLING_SEED = getattr(settings, 'FEED_SAMPLING_SEED', '')
+
+# fields of parsed feed kept for scheduler, see scheduler.schedule
+feed_fields = ('ttl', 'sy_updateperiod', 'sy_updatefrequency')
+entry_fields = ('published_parsed', 'updated_parsed')
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+class InlineExecutor(Executor):
+    """Runs every call right away in the calling thread"""
+
+    def submit(self, fn, *args, **kwargs):
+        future = Future()
+        try:
+            future.set_result(fn(*args, **kwargs))
+        except BaseException as error:
+            future.set_exception(error)
+        return future
+
+
+backends = {
+    'inline': lambda: InlineExecutor(),
+    'thread': lambda: ThreadPoolExecutor(max_workers=PARSE_WORKERS, thread_name_prefix='feed-parse'),
+    'process': lambda: ProcessPoolExecutor(max_workers=PARSE_WORKERS),
+}
+
+
+def get_executor():
+    """Returns executor of FEED_PARSE_BACKEND, created once per process"""
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            if PARSE_BACKEND not in backends:
+                raise ImproperlyConfigured("FEED_PARSE_BACKEND must be one of: {}".format(", ".join(backends)))
+            _executor = backends[PARSE_BACKEND]()
+        return _executor
+
+
+def parse_feed(content, headers, href, tag_sets=None, seed=SAMPLING_SEED):
+    """Parses downloaded feed into compact parsed feed, run by executor, see get_executor
+    :argument
+    content - raw bytes of the feed
+    headers - dictionary of response headers
+    href - url of the feed after redirects
+    tag_sets - optional dictionary {category id: tuple of tag names} of categories in which
+    articles are matched, see pipeline.find_matching_entries
+    :returns
+    FeedParserDict with bozo and headers, feed and entries reduced to fields read by scheduler,
+    'articles' - ArticleRecord list, as returned by parse_entries, matched articles have simhash set,
+    'matches' - dictionary {category id: list of (index of article, relevance)}"""
+    parsed_feed = feedparser.parse(content, response_headers=headers)
+    parsed_feed['href'] = href
+    articles = parse_entries(parsed_feed)
+    positions = {id(article): index for index, article in enumerate(articles)}
+    matches = {
+        category_id: [(positions[id(article)], article.relevance)
+                      for article in find_matching_entries(articles, get_tag_matcher(tags), seed)]
+        for category_id, tags in (tag_sets or {}).items()
+    }
+    return feedparser.FeedParserDict(
+        bozo=parsed_feed.get('bozo', False),
+        headers=parsed_feed.get('headers', {}),
+        feed=feedparser.FeedParserDict({key: parsed_feed.feed[key] for key in feed_fields if key in parsed_feed.feed}),
+        entries=[feedparser.FeedParserDict({key: entry[key] for key in entry_fields if entry.get(key)})
+                 for entry in parsed_feed.entries],
+        articles=articles,
+        matches=matches,
+    )
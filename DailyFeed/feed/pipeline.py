@@ -0,0 +1,287 @@
+import array
+import calendar
+import datetime
+import hashlib
+import heapq
+import operator
+import re
+import sys
+import time
+from functools import lru_cache
+from urllib.parse import urlparse, urlunparse, parse_qsl, urlencode
+
+from nltk.stem import PorterStemmer
+
+html_cleaner_regex = re.compile('<.*?>')
+word_regex = re.compile(r'\w+')
+
+porter = PorterStemmer()
+
+tracking_params = ('utm_', 'fbclid', 'gclid', 'ocid', 'cmpid')
+
+# articles whose SimHash fingerprints differ in at most this many of 64 bits are the same story
+near_duplicate_distance = 7
+# shorter texts give fingerprints too unstable to compare
+simhash_min_tokens = 5
+
+
+class ArticleRecord:
+    """Article passed through the pipeline, from parse_entries to the page. Slots instead of
+    dictionary, because thousands of them are built, cached and merged on every refresh.
+    published - seconds since epoch (UTC), compared and cached as it is, formatted only for the page
+    website - interned netloc, articles of one site share the string
+    relevance, simhash - set by find_matching_entries"""
+    __slots__ = ('url', 'title', 'summary', 'published', 'website', 'relevance', 'simhash')
+
+    def __init__(self, url, title, summary, published, website, relevance=0, simhash=None):
+        self.url = url
+        self.title = title
+        self.summary = summary
+        self.published = published
+        self.website = sys.intern(website)
+        self.relevance = relevance
+        self.simhash = simhash
+
+    def __reduce__(self):
+        # plain tuple of values, pickle does not repeat names of fields for every article
+        return ArticleRecord, (self.url, self.title, self.summary, self.published, self.website,
+                               self.relevance, self.simhash)
+
+    def __repr__(self):
+        return "ArticleRecord({!r}, published={})".format(self.url, self.published)
+
+    @property
+    def published_text(self):
+        return time.strftime('%Y-%m-%d %H:%M', time.gmtime(self.published))
+
+    @property
+    def simhash_text(self):
+        """Fingerprint as hex text, 64-bit numbers do not fit into numbers of JavaScript"""
+        return format(self.simhash, '016x') if self.simhash is not None else ''
+
+    def as_json(self):
+        """Fields shown by the page, for json.dumps(default=ArticleRecord.as_json)"""
+        return {'url': self.url, 'title': self.title, 'published': self.published_text,
+                'website': self.website, 'simhash': self.simhash_text}
+
+
+def parse_entries(parsed_feed):
+    """Turns entries of feed parsed by feedparser into list of ArticleRecord,
+    summary is without html, website is netloc of the site"""
+    return [
+        ArticleRecord(getattr(e, 'link', '----'),
+                      getattr(e, 'title', '----'),
+                      re.sub(html_cleaner_regex, ' ', getattr(e, 'summary', '-----')),
+                      struct_time_to_epoch(get_date(e)),
+                      urlparse(getattr(parsed_feed, 'link', getattr(e, 'link', getattr(parsed_feed, 'href', "unknown")))).netloc)
+        for e in parsed_feed.entries]
+
+
+@lru_cache(maxsize=100000)
+def stem(word):
+    return porter.stem(word)
+
+
+def tokenize(text):
+    """Returns stemmed words of text, without html tags and punctuation"""
+    return [stem(w) for w in word_regex.findall(re.sub(html_cleaner_regex, ' ', text.lower()))]
+
+
+class TagMatcher:
+    """Stemmed category tags prepared for matching, single word tags are kept in a set,
+    multi-word tags are indexed by their first word and compared with following words"""
+
+    def __init__(self, tags):
+        self.words = set()
+        self.phrases = {}
+        for tag in tags:
+            tag_tokens = tuple(tokenize(tag))
+            if len(tag_tokens) == 1:
+                self.words.add(tag_tokens[0])
+            elif tag_tokens:
+                self.phrases.setdefault(tag_tokens[0], []).append(tag_tokens)
+
+    def count(self, tokens):
+        """Returns number of tag occurrences in tokens"""
+        hits = 0
+        for i, token in enumerate(tokens):
+            if token in self.words:
+                hits += 1
+            for phrase in self.phrases.get(token, ()):
+                if tuple(tokens[i:i + len(phrase)]) == phrase:
+                    hits += 1
+        return hits
+
+
+@lru_cache(maxsize=256)
+def _compile_tags(tags):
+    return TagMatcher(tags)
+
+
+def get_tag_matcher(tags):
+    """Returns TagMatcher for given tag names, matchers are compiled once per set of tags,
+    so changing tags of category gives new matcher"""
+    return _compile_tags(tuple(sorted({t.lower() for t in tags})))
+
+
+@lru_cache(maxsize=100000)
+def _spread_token_hash(token):
+    """64-bit hash of token with every bit moved to its own 16-bit slot, so that adding
+    spread hashes counts ones on each bit position of all tokens at once"""
+    bits = format(int(hashlib.md5(token.encode('utf-8')).hexdigest()[:16], 16), '064b')
+    return int(''.join('000000000000000' + bit for bit in bits), 2)
+
+
+def simhash(tokens):
+    """Returns 64-bit SimHash fingerprint of tokens, texts sharing most of their tokens
+    get fingerprints differing in few bits, None when there are too few tokens"""
+    if len(tokens) < simhash_min_tokens:
+        return None
+    tokens = tokens[:0xffff]
+    counts = array.array('H', sum(map(_spread_token_hash, tokens)).to_bytes(128, 'big'))
+    if sys.byteorder == 'little':
+        counts.byteswap()
+    half = len(tokens) / 2
+    return int(''.join(['1' if count > half else '0' for count in counts]), 2)
+
+
+def simhash_to_signed(fingerprint):
+    """Returns fingerprint as signed 64-bit number, which fits into BigIntegerField, None stays None"""
+    if fingerprint is None or fingerprint < 1 << 63:
+        return fingerprint
+    return fingerprint - (1 << 64)
+
+
+def simhash_from_signed(value):
+    """Reverse of simhash_to_signed"""
+    if value is None or value >= 0:
+        return value
+    return value + (1 << 64)
+
+
+class SimHashIndex:
+    """LSH index of SimHash fingerprints, finds fingerprints differing in at most max_distance
+    bits without comparing with all of them. Fingerprint is split into max_distance + 1 bands,
+    near fingerprints have at least one band equal, so only fingerprints sharing a band are compared.
+    With default 8 bands of 8 bits unrelated fingerprint shares a band with about 1/32 of indexed ones,
+    so the index is meant for at most a few hundred fingerprints, like the 100 unique articles
+    of every page (see unique_entries). Wider bands cannot be used instead: 7 differing bits may
+    fall into 7 bands, so near fingerprints are sure to share only one band of 8"""
+
+    def __init__(self, max_distance=near_duplicate_distance):
+        self.max_distance = max_distance
+        band_width = 64 // (max_distance + 1)
+        self.bands = [(i * band_width, (1 << band_width) - 1) for i in range(max_distance)]
+        self.bands.append((max_distance * band_width, (1 << (64 - max_distance * band_width)) - 1))
+        self.buckets = [{} for _ in self.bands]
+
+    def has_near(self, fingerprint):
+        for (shift, mask), buckets in zip(self.bands, self.buckets):
+            for candidate in buckets.get((fingerprint >> shift) & mask, ()):
+                if bin(candidate ^ fingerprint).count('1') <= self.max_distance:
+                    return True
+        return False
+
+    def add(self, fingerprint):
+        for (shift, mask), buckets in zip(self.bands, self.buckets):
+            buckets.setdefault((fingerprint >> shift) & mask, []).append(fingerprint)
+
+
+def stable_fraction(text, seed=''):
+    """Returns number from [0, 1) which is always the same for the same text and seed"""
+    digest = hashlib.md5("{}{}".format(seed, text).encode('utf-8')).hexdigest()
+    return int(digest[:8], 16) / 0x100000000
+
+
+def find_matching_entries(entries, tag_matcher, seed=''):
+    """Keeps entries which contain any of category tags, other entries are sampled
+    deterministically by hash of their url, with chance growing for further entries.
+    Each kept entry gets relevance: number of tag hits plus the hash fraction,
+    which breaks ties between articles published at the same time, and simhash
+    of its words, see unique_entries. Entries are changed in place
+    :argument
+    entries - list of ArticleRecord, newest first
+    tag_matcher - TagMatcher of category, see get_tag_matcher
+    seed - changes which of the not matching entries are sampled"""
+    add_treshold = 0.8
+    treshold_decrease = 1.0/(len(entries) + 1)
+    matching_entries = []
+    for entry in entries:
+        tokens = tokenize(entry.summary) + tokenize(entry.title) if entry.title != '' else []
+        hits = tag_matcher.count(tokens)
+        chance = stable_fraction(entry.url + entry.title, seed)
+        if hits or chance > add_treshold:
+            entry.relevance = hits + chance
+            entry.simhash = simhash(tokens)
+            matching_entries.append(entry)
+        add_treshold -= treshold_decrease
+    return matching_entries
+
+
+# sort key of articles, newer and then more relevant articles are greater
+article_order = operator.attrgetter('published', 'relevance')
+
+
+def merge_newest(grouped_entries, limit=100):
+    """Merges lists of articles into list of at most limit newest articles, without
+    sorting all of them, duplicates of newer articles are skipped, see unique_entries
+    :argument
+    grouped_entries - iterable of lists of articles, each sorted by article_order, newest first
+    :returns
+    list of articles, newest first"""
+    return unique_entries(heapq.merge(*grouped_entries, key=article_order, reverse=True), limit)
+
+
+def unique_entries(entries, limit=None):
+    """Returns first of entries which are not duplicates, at most limit. Entry is a duplicate
+    when its normalized url was seen before or its 'simhash' is near simhash of entry seen
+    before, which happens when the same story is syndicated by many sites. Only unique entries
+    are indexed, so limit bounds the size of SimHashIndex"""
+    unique = []
+    urls = set()
+    simhash_index = SimHashIndex()
+    for entry in entries:
+        url = normalize_url(entry.url)
+        fingerprint = entry.simhash
+        if url in urls or (fingerprint is not None and simhash_index.has_near(fingerprint)):
+            continue
+        urls.add(url)
+        if fingerprint is not None:
+            simhash_index.add(fingerprint)
+        unique.append(entry)
+        if len(unique) == limit:
+            break
+    return unique
+
+
+def get_date(entry):
+    published_date = getattr(entry, 'published_parsed', False) or getattr(entry, 'updated_parsed', False)
+    if isinstance(published_date, time.struct_time):
+        return published_date
+    return time.struct_time(datetime.datetime.now().replace(hour=0, minute=0, second=0).timetuple())
+
+
+def epoch_to_datetime(published):
+    """Returns aware datetime of published of ArticleRecord"""
+    return datetime.datetime.fromtimestamp(published, datetime.timezone.utc)
+
+
+def struct_time_to_epoch(published):
+    """Returns seconds since epoch of struct_time in UTC, cheaper to compare and keep than formatted date"""
+    return calendar.timegm(published)
+
+
+def normalize_url(url):
+    """Returns url with lowercase scheme and host, without fragment, trailing slash
+    and tracking query parameters, used to recognize the same article"""
+    parsed = urlparse(url.strip())
+    query = [(key, value) for key, value in parse_qsl(parsed.query, keep_blank_values=True)
+             if not key.lower().startswith(tracking_params)]
+    return urlunparse((
+        parsed.scheme.lower(),
+        parsed.netloc.lower(),
+        parsed.path.rstrip('/') or '/',
+        '',
+        urlencode(sorted(query)),
+        ''
+    ))
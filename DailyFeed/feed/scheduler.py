@@ -0,0 +1,129 @@
+import calendar
+import datetime
+import re
+import statistics
+
+from django.conf import settings
+from django.db import connection
+from django.utils import timezone
+
+from .models import Source
+
+MIN_POLL_INTERVAL = getattr(settings, 'FEED_MIN_POLL_INTERVAL', 5 * 60)
+MAX_POLL_INTERVAL = getattr(settings, 'FEED_MAX_POLL_INTERVAL', 24 * 60 * 60)
+
+# interval grows by this factor after every poll which brought nothing new
+unchanged_growth = 1.5
+# publish interval is a median of gaps between this many newest entries
+publish_history = 20
+update_periods = {
+    'hourly': 60 * 60,
+    'daily': 24 * 60 * 60,
+    'weekly': 7 * 24 * 60 * 60,
+    'monthly': 30 * 24 * 60 * 60,
+    'yearly': 365 * 24 * 60 * 60,
+}
+max_age_regex = re.compile(r'max-age\s*=\s*(\d+)')
+scheduling_fields = ['last_polled', 'last_changed', 'publish_interval', 'failures', 'poll_interval', 'next_poll']
+
+
+def feed_hint(parsed_feed):
+    """Returns interval (seconds) before which publisher asks not to download the feed again,
+    the longest of <ttl> (minutes), sy:updatePeriod / sy:updateFrequency and Cache-Control
+    max-age, 0 when feed gives no hint"""
+    feed = parsed_feed.get('feed', {})
+    hints = [0]
+    try:
+        hints.append(int(feed.get('ttl', 0)) * 60)
+    except ValueError:
+        pass
+    period = update_periods.get(feed.get('sy_updateperiod', '').strip().lower())
+    if period:
+        try:
+            hints.append(period // max(1, int(feed.get('sy_updatefrequency', 1))))
+        except ValueError:
+            hints.append(period)
+    headers = {key.lower(): value for key, value in parsed_feed.get('headers', {}).items()}
+    max_age = max_age_regex.search(headers.get('cache-control', ''))
+    if max_age:
+        hints.append(int(max_age.group(1)))
+    return max(hints)
+
+
+def observed_publish_interval(entries):
+    """Returns median time (seconds) between publications of newest entries of parsed feed,
+    None when fewer than 3 entries have dates"""
+    times = sorted({
+        calendar.timegm(entry.get('published_parsed') or entry.get('updated_parsed'))
+        for entry in entries if entry.get('published_parsed') or entry.get('updated_parsed')
+    })[-publish_history:]
+    gaps = [newer - older for older, newer in zip(times, times[1:])]
+    if len(gaps) < 2:
+        return None
+    return max(1, int(statistics.median(gaps)))
+
+
+def schedule(source, parsed_feed, changed, now=None):
+    """Updates scheduling state of source after it was polled, source is not saved.
+    Feed which brought new articles is polled twice per its publish interval, every poll
+    without news makes interval longer, hints of the publisher (see feed_hint) are never
+    undercut. Failing source is retried after exponentially growing time, its poll_interval
+    is kept for the time it works again
+    :argument
+    parsed_feed - parsed feed, as returned by fetch_feed, None when download failed
+    changed - True when feed brought new articles"""
+    now = now or timezone.now()
+    source.last_polled = now
+    if parsed_feed is None:
+        source.failures += 1
+        interval = min(MAX_POLL_INTERVAL, source.poll_interval * 2 ** min(source.failures, 16))
+    else:
+        source.failures = 0
+        if changed:
+            source.last_changed = now
+        source.publish_interval = observed_publish_interval(parsed_feed.get('entries', [])) or source.publish_interval
+        interval = source.publish_interval // 2 if source.publish_interval else source.poll_interval
+        if not changed:
+            interval = max(interval, source.poll_interval * unchanged_growth)
+        interval = int(min(MAX_POLL_INTERVAL, max(MIN_POLL_INTERVAL, interval, feed_hint(parsed_feed))))
+        source.poll_interval = interval
+    source.next_poll = now + datetime.timedelta(seconds=interval)
+
+
+def is_backing_off(source, now=None):
+    """True when last downloads of source failed and its retry time has not come yet"""
+    return bool(source.failures) and source.next_poll is not None and source.next_poll > (now or timezone.now())
+
+
+def record_attempts(sources, fetched_links, now=None):
+    """Updates backoff of sources downloaded during request: sources missing in fetched_links
+    failed once more, sources which failed before and now work start from scratch.
+    Only sources whose state changed are saved, with one query per distinct new state, so sources
+    failing or recovering together cost single query, however many of them there are"""
+    now = now or timezone.now()
+    changed_sources = []
+    for source in sources:
+        if source.link not in fetched_links:
+            schedule(source, None, False, now)
+        elif source.failures:
+            source.failures = 0
+            source.last_polled = now
+            source.next_poll = now + datetime.timedelta(seconds=source.poll_interval)
+        else:
+            continue
+        changed_sources.append(source)
+    states = {}
+    for source in changed_sources:
+        states.setdefault(tuple(getattr(source, field) for field in scheduling_fields), []).append(source.id)
+    for state, ids in states.items():
+        Source.objects.filter(id__in=ids).update(**dict(zip(scheduling_fields, state)))
+
+
+def record_background_attempts(sources, links, fetched_links):
+    """Same as record_attempts for sources of links refreshed in background thread, see
+    feed_cache.refresh_in_background. The thread opens its own database connection,
+    which is closed right away"""
+    try:
+        record_attempts([source for source in sources if source.link in links], fetched_links)
+    finally:
+        connection.close()
@@ -0,0 +1,74 @@
+from django.db.models import Exists, OuterRef
+
+from .models import Article, ArticleTerm, CategoryArticle
+from .pipeline import tokenize
+
+max_term_length = ArticleTerm._meta.get_field('term').max_length
+max_query_terms = 10
+counted_postings = 1000
+
+
+def article_terms(title, summary):
+    """Returns distinct stemmed words of article, as kept in the index"""
+    return {term[:max_term_length] for term in tokenize(title) + tokenize(summary)}
+
+
+def index_articles(articles):
+    """Adds articles to the inverted index, terms which are already indexed are skipped
+    :argument
+    articles - Article instances with id"""
+    ArticleTerm.objects.bulk_create([
+        ArticleTerm(term=term, article_id=article.id, published=article.published)
+        for article in articles for term in article_terms(article.title, article.summary)
+    ], ignore_conflicts=True)
+
+
+def index_missing_articles(chunk_size=1000):
+    """Indexes articles saved before the index existed
+    :returns
+    number of indexed articles"""
+    indexed = 0
+    last_id = 0
+    while True:
+        articles = list(
+            Article.objects.filter(id__gt=last_id, terms__isnull=True).order_by('id')
+            .only('id', 'title', 'summary', 'published')[:chunk_size]
+        )
+        if not articles:
+            return indexed
+        index_articles(articles)
+        indexed += len(articles)
+        last_id = articles[-1].id
+
+
+def query_terms(query):
+    return sorted({term[:max_term_length] for term in tokenize(query)})[:max_query_terms]
+
+
+def search_articles(query, category_id=None, limit=50):
+    """Returns newest articles containing all words of query, in any form (words are stemmed).
+    Postings of the rarest word are read newest first and each is checked for other words
+    and category in the index, so reading stops as soon as limit articles are found
+    :argument
+    category_id - when given, only articles matched in this category are searched
+    :returns
+    list of Article instances, newest first"""
+    terms = query_terms(query)
+    if not terms:
+        return []
+    if len(terms) > 1:
+        # words with more postings than counted_postings are all common enough to start with any of them
+        counts = {term: ArticleTerm.objects.filter(term=term)[:counted_postings].count() for term in terms}
+        if not all(counts.values()):
+            return []
+        terms.sort(key=counts.get)
+    postings = ArticleTerm.objects.filter(term=terms[0])
+    for term in terms[1:]:
+        postings = postings.filter(Exists(ArticleTerm.objects.filter(term=term, article_id=OuterRef('article_id'))))
+    if category_id is not None:
+        postings = postings.filter(Exists(
+            CategoryArticle.objects.filter(category_id=category_id, article_id=OuterRef('article_id'))
+        ))
+    article_ids = list(postings.order_by('-published').values_list('article_id', flat=True)[:limit])
+    articles = Article.objects.in_bulk(article_ids)
+    return [articles[article_id] for article_id in article_ids if article_id in articles]
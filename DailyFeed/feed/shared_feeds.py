@@ -0,0 +1,102 @@
+"""Feeds are shared by all categories subscribing to them: entries of every feed are parsed
+and cached once per link, categories only match their tags on them (see CategoryView.build_record),
+so a feed is downloaded once no matter how many categories use it"""
+import time
+from collections import namedtuple
+
+from django.core.cache import cache
+
+from .feed_cache import CACHE_TIME, FRESH_TIME, RECORD_FORMAT, link_hash, source_version_key, get_versions, \
+    get_feeds, is_fresh
+from .fetcher import FETCH_TIMEOUT, iter_feeds, fetch_feeds, resolve_websites, remaining_time
+from .metrics import increment
+
+SharedFeed = namedtuple('SharedFeed', ['entries', 'etag', 'modified', 'fetched'])
+SharedFeed.__doc__ = """Feed of single source kept in cache for all categories
+entries - ArticleRecord list, as returned by parse_entries, with websites resolved
+etag, modified - validators of the download, used for conditional request when record is stale
+fetched - timestamp of the download"""
+
+
+def shared_feed_keys(links):
+    """Returns dictionary {link: cache key}, keys contain version of source only"""
+    versions = get_versions([source_version_key(link) for link in links])
+    return {
+        link: "shared{}_{}.{}".format(RECORD_FORMAT, link_hash(link), versions[source_version_key(link)])
+        for link in links
+    }
+
+
+def read_shared_feeds(links, now=None):
+    """:returns
+    (dictionary {link: cache key}, dictionary {link: SharedFeed} of cached feeds,
+    links of feeds downloaded less than FRESH_TIME ago, which need no download)"""
+    keys = shared_feed_keys(links)
+    records = get_feeds(keys)
+    now = now or time.time()
+    fresh_links = [link for link in links if link in records and is_fresh(records[link], now, FRESH_TIME)]
+    increment('feed_shared_total', len(fresh_links), result='hit')
+    increment('feed_shared_total', len(links) - len(fresh_links), result='download')
+    return keys, records, fresh_links
+
+
+def store_shared_feed(keys, link, parsed_feed, previous=None, timeout=FETCH_TIMEOUT):
+    """Saves downloaded feed for all categories, entries of previous record are reused
+    when feed did not change
+    :argument
+    parsed_feed - parsed feed, as returned by fetch_feed
+    previous - SharedFeed whose validators were sent with request
+    timeout - seconds for resolving websites of entries, see fetcher.resolve_websites
+    :returns
+    SharedFeed"""
+    return store_shared_feeds(keys, {link: parsed_feed}, {link: previous} if previous else {}, timeout)[link]
+
+
+def store_shared_feeds(keys, parsed_feeds, previous, timeout=FETCH_TIMEOUT):
+    """Same as store_shared_feed for many feeds, their websites are resolved in one concurrent batch
+    :argument
+    parsed_feeds - dictionary {link: parsed feed}
+    previous - dictionary {link: SharedFeed} of cached feeds
+    :returns
+    dictionary {link: SharedFeed}"""
+    changed_feeds = {link: parsed_feed for link, parsed_feed in parsed_feeds.items()
+                     if parsed_feed.status != 304 or link not in previous}
+    resolve_websites([article for parsed_feed in changed_feeds.values() for article in parsed_feed.articles], timeout)
+    now = time.time()
+    records = {
+        link: SharedFeed(
+            parsed_feed.articles if link in changed_feeds else previous[link].entries,
+            parsed_feed.etag, parsed_feed.modified, now
+        ) for link, parsed_feed in parsed_feeds.items()
+    }
+    cache.set_many({keys[link]: record for link, record in records.items()}, CACHE_TIME)
+    return records
+
+
+def validators_of(records):
+    return {link: (record.etag, record.modified) for link, record in records.items()}
+
+
+def fetch_shared_feeds(links, timeout=FETCH_TIMEOUT):
+    """Returns dictionary {link: SharedFeed} for given links, fresh records of feeds downloaded
+    for other categories are used, other feeds are downloaded and stored at once"""
+    keys, records, fresh_links = read_shared_feeds(links)
+    stale_links = [link for link in links if link not in fresh_links]
+    shared_feeds = {link: records[link] for link in fresh_links}
+    deadline = time.monotonic() + timeout
+    parsed_feeds = fetch_feeds(stale_links, timeout, validators_of(records))
+    shared_feeds.update(store_shared_feeds(keys, parsed_feeds, records, remaining_time(deadline)))
+    return shared_feeds
+
+
+def iter_shared_feeds(links, timeout=FETCH_TIMEOUT):
+    """Yields (link, SharedFeed) for given links, fresh records of feeds downloaded
+    for other categories right away, other feeds as soon as they are downloaded.
+    Websites of feeds are resolved in the time left of the batch, so they cannot hold the stream longer"""
+    keys, records, fresh_links = read_shared_feeds(links)
+    for link in fresh_links:
+        yield link, records[link]
+    stale_links = [link for link in links if link not in fresh_links]
+    deadline = time.monotonic() + timeout
+    for link, parsed_feed in iter_feeds(stale_links, timeout, validators_of(records)):
+        yield link, store_shared_feed(keys, link, parsed_feed, records.get(link), remaining_time(deadline))
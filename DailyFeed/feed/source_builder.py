@@ -1,17 +1,72 @@
-from .models import Source
+from django.db import transaction
+
+from .feed_cache import bump_page_version, bump_versions_on_commit
+from .models import Source, Category, Article
+from .pipeline import normalize_url
 
 
 def build_category_sources(category, rss_feeds):
 	rss_feeds = [rss.lower() for rss in rss_feeds]
 	tags = [t.name for t in category.search_tags.all()]
 	category_feeds = [rss for rss in rss_feeds if any([t in rss for t in tags])]
-	category_feeds = [rss for rss in category_feeds if not check_if_source_exists(category, rss)]
-	for source in category_feeds:
-		new_source = Source(name=source, link=source)
-		new_source.save()
-		category.sources.add(new_source)
+	category.sources.add(*get_sources({rss: rss for rss in category_feeds}).values())
+	bump_versions_on_commit(bump_page_version, [category.id])
 
 
 def check_if_source_exists(category, rss_link):
-	existing_sources = category.sources.all().filter(link=rss_link)
+	existing_sources = category.sources.all().filter(normalized_link=normalize_url(rss_link))
 	return existing_sources.exists()
+
+
+def get_sources(feeds):
+	"""Returns sources of feeds, there is one source of every feed (by normalized link),
+	shared by all categories, so that the feed is downloaded once. Missing sources are
+	inserted with bulk_create, sources inserted meanwhile by concurrent request are used instead
+	:argument
+	feeds - dictionary {link: name of source}
+	:returns
+	dictionary {link: Source}"""
+	normalized_links = {link: normalize_url(link) for link in feeds}
+	sources = {}
+	for source in Source.objects.filter(normalized_link__in=set(normalized_links.values())).order_by('id'):
+		sources.setdefault(source.normalized_link, source)
+	new_sources = {}
+	for link, name in feeds.items():
+		normalized_link = normalized_links[link]
+		if normalized_link not in sources:
+			new_sources.setdefault(normalized_link, Source(name=name, link=link, normalized_link=normalized_link))
+	if new_sources:
+		Source.objects.bulk_create(new_sources.values(), ignore_conflicts=True)
+		# primary keys are not returned by bulk_create on every database
+		sources.update({
+			source.normalized_link: source for source in Source.objects.filter(normalized_link__in=new_sources)
+		})
+	return {link: sources[normalized_link] for link, normalized_link in normalized_links.items()}
+
+
+@transaction.atomic
+def merge_duplicate_sources(source_model=Source, category_model=Category, article_model=Article):
+	"""Fills normalized_link of sources saved before it existed and merges sources of the same
+	feed into the oldest one, which takes over categories and articles of the others,
+	run by migration 0003_merge_duplicate_sources with historical models
+	:returns
+	number of removed sources"""
+	sources = list(source_model.objects.order_by('id'))
+	kept = {}
+	duplicates = {}
+	for source in sources:
+		source.normalized_link = normalize_url(source.link)
+		kept.setdefault(source.normalized_link, source)
+		if kept[source.normalized_link] is not source:
+			duplicates[source.id] = kept[source.normalized_link].id
+	through = category_model.sources.through
+	links = through.objects.filter(source_id__in=duplicates).values_list('category_id', 'source_id')
+	through.objects.bulk_create([
+		through(category_id=category_id, source_id=duplicates[source_id]) for category_id, source_id in links
+	], ignore_conflicts=True)
+	for duplicate_id, source_id in duplicates.items():
+		article_model.objects.filter(source_id=duplicate_id).update(source_id=source_id)
+	source_model.objects.filter(id__in=duplicates).delete()
+	# normalized_link is unique, so it is saved after duplicates are gone
+	source_model.objects.bulk_update(kept.values(), ['normalized_link'])
+	return len(duplicates)
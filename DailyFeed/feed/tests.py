@@ -1 +1,899 @@
-# Create your tests here.
+import asyncio
+import datetime
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from unittest import mock
+from urllib.parse import urlsplit
+
+import django
+import feedparser
+import requests
+from asgiref.sync import async_to_sync
+from django.core import signals
+from django.core.cache import cache
+from django.db import close_old_connections, connection
+from django.db.migrations.executor import MigrationExecutor
+from django.test import RequestFactory, TestCase, TransactionTestCase, override_settings
+from django.utils import timezone
+
+from .feed_cache import FeedRecord, feed_keys, set_feeds, is_fresh, page_key, lock_feeds, bump_page_version
+from .models import Category, Source, SearchTag, Article, CategoryArticle
+from .pipeline import ArticleRecord, normalize_url, get_tag_matcher, find_matching_entries, merge_newest, simhash, \
+    tokenize, simhash_to_signed, simhash_from_signed
+from .parsing import InlineExecutor, parse_feed
+from .search import index_articles, search_articles
+from .discovery import discover_feeds, find_feed_links
+from .feed_cache import get_feeds
+from .opml import parse_opml, import_feeds
+from .asgi import FeedASGIHandler
+from . import async_fetcher
+from .fetcher import fetch_feed, batch_deadline, resolve_websites
+from .shared_feeds import fetch_shared_feeds, shared_feed_keys, store_shared_feed
+from .ingest import get_due_sources, ingest_sources
+from .scheduler import schedule
+from .source_builder import build_category_sources
+from .views import CategoryView, FindSourcesView
+
+test_caches = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+
+
+@override_settings(CACHES=test_caches)
+class FeedTestCase(TestCase):
+
+    def setUp(self):
+        cache.clear()
+
+    def create_category(self, name, sources_count, tags_count=3):
+        category = Category.objects.create(name=name)
+        for number in range(tags_count):
+            category.search_tags.add(SearchTag.objects.create(name="{}tag{}".format(name, number)))
+        for number in range(sources_count):
+            category.sources.add(Source.objects.create(
+                name="{}{}".format(name, number), link="http://{}{}.example.com/rss".format(name, number)
+            ))
+        return category
+
+    def store_articles(self, category):
+        for source in category.sources.all():
+            article = Article.objects.create(
+                source=source, url=source.link + "/1", normalized_url=source.link + "/1",
+                title="Article", website="example.com", published=timezone.now()
+            )
+            CategoryArticle.objects.create(category=category, article=article, published=article.published)
+
+    def cache_feeds(self, category):
+        links = [source.link for source in category.sources.all()]
+        set_feeds(feed_keys(category.id, links), {
+            link: FeedRecord([ArticleRecord(
+                "http://example.com/{}".format(number), "Article", "", 1577872800, "example.com"
+            )], '', '', time.time()) for number, link in enumerate(links)
+        })
+
+
+class QueryCountTests(FeedTestCase):
+    """Pages should need the same number of queries, no matter how many sources,
+    tags and categories there are"""
+
+    def test_category_with_stored_articles(self):
+        for name, sources_count in (('small', 2), ('big', 30)):
+            category = self.create_category(name, sources_count, tags_count=sources_count)
+            self.store_articles(category)
+            # categories, category, its sources, its tags, articles
+            with self.assertNumQueries(5):
+                response = self.client.get('/category/{}'.format(category.id))
+            self.assertEqual(len(response.context['articles']), sources_count)
+
+    def test_category_with_cached_feeds(self):
+        for name, sources_count in (('small', 2), ('big', 30)):
+            category = self.create_category(name, sources_count, tags_count=sources_count)
+            self.cache_feeds(category)
+            # categories, category, its sources, its tags, stored articles (none)
+            with self.assertNumQueries(5):
+                response = self.client.get('/category/{}'.format(category.id))
+            self.assertEqual(len(response.context['articles']), sources_count)
+
+    def test_rendered_page_is_cached(self):
+        category = self.create_category('news', 2)
+        self.cache_feeds(category)
+        url = '/category/{}'.format(category.id)
+        content = self.client.get(url).content
+        with self.assertNumQueries(0):
+            self.assertEqual(self.client.get(url).content, content)
+
+    def test_suggested_categories(self):
+        for number in range(10):
+            self.create_category("cat{}".format(number), 0)
+        view = FindSourcesView()
+        # categories, their tags
+        with self.assertNumQueries(2):
+            view.get_suggested_categories(["http://example.com/cat1tag0/rss", "http://example.com/other/rss"])
+
+    def test_build_category_sources(self):
+        category = self.create_category("news", 0, tags_count=1)
+        category.sources.add(Source.objects.create(name="old", link="http://example.com/newstag0/1"))
+        feeds = ["http://example.com/newstag0/{}".format(number) for number in range(20)]
+        # tags, existing sources, insert of new sources, new sources, existing links, links to category,
+        # forgetting validators of subscribed sources
+        with self.assertNumQueries(7):
+            build_category_sources(category, feeds)
+        self.assertEqual(category.sources.count(), 20)
+
+
+@override_settings(CACHES=test_caches)
+class CacheInvalidationTests(TransactionTestCase):
+    """Versions are bumped after commit, so cached pages never show state from before the change"""
+
+    def setUp(self):
+        cache.clear()
+
+    create_category = FeedTestCase.create_category
+    cache_feeds = FeedTestCase.cache_feeds
+
+    def test_tag_changes_invalidate_pages(self):
+        categories = [self.create_category(name, 1, tags_count=0) for name in ('news', 'tech')]
+        shared_tag = SearchTag.objects.create(name="sharedtag")
+        for category in categories:
+            category.search_tags.add(shared_tag)
+            self.cache_feeds(category)
+        urls = ['/category/{}'.format(category.id) for category in categories]
+        for url in urls:
+            self.assertIn(b"sharedtag", self.client.get(url).content)
+
+        self.client.post('/category/{}/tags/new'.format(categories[0].id), {
+            'form-TOTAL_FORMS': 1, 'form-INITIAL_FORMS': 0, 'form-0-name': "newtag"
+        })
+        self.assertIn(b"newtag", self.client.get(urls[0]).content)
+
+        self.client.get('/category/{}/tags/{}/delete'.format(categories[0].id, shared_tag.id),
+                        HTTP_REFERER=urls[0])
+        for url in urls:
+            self.assertNotIn(b"sharedtag", self.client.get(url).content)
+
+    def test_source_and_category_changes_invalidate_pages(self):
+        category = self.create_category('news', 2)
+        self.cache_feeds(category)
+        url = '/category/{}'.format(category.id)
+        self.assertIn("Masz 2 źródeł", self.client.get(url).content.decode('utf-8'))
+
+        self.client.get('/category/{}/source/{}/delete'.format(category.id, category.sources.first().id))
+        self.assertIn("Masz 1 źródeł", self.client.get(url).content.decode('utf-8'))
+        self.client.post('/category/new', {'name': "sport"})
+        self.assertIn("sport", self.client.get(url).content.decode('utf-8'))
+
+
+class MetricsTests(FeedTestCase):
+    """Stages of category page are reported in Server-Timing header and in /metrics"""
+
+    def read_metrics(self):
+        """:returns
+        dictionary {metric with labels: value} read from /metrics"""
+        response = self.client.get('/metrics')
+        self.assertTrue(response['Content-Type'].startswith('text/plain; version=0.0.4'))
+        lines = response.content.decode('utf-8').splitlines()
+        self.assertTrue(all(line.startswith('# TYPE ') for line in lines if line.startswith('#')))
+        return dict(line.rsplit(' ', 1) for line in lines if line and not line.startswith('#'))
+
+    def test_category_page_is_measured(self):
+        category = self.create_category('news', 2)
+        self.cache_feeds(category)
+        before = self.read_metrics()
+        response = self.client.get('/category/{}'.format(category.id))
+
+        timings = dict(timing.split(';dur=') for timing in response['Server-Timing'].split(', '))
+        self.assertEqual(set(timings), {'page', 'query', 'cache', 'merge', 'render', 'total'})
+        durations = {stage: float(duration) for stage, duration in timings.items()}
+        self.assertTrue(all(duration >= 0 for duration in durations.values()))
+        self.assertGreaterEqual(durations['total'], max(durations.values()))
+
+        after = self.read_metrics()
+        hits = 'feed_cache_total{{category="{}",result="hit"}}'.format(category.id)
+        self.assertEqual(int(after[hits]) - int(before.get(hits, 0)), 2)
+        for suffix in ('_bucket{{category="{}",stage="cache",le="+Inf"}}', '_count{{category="{}",stage="cache"}}'):
+            name = 'feed_stage_seconds' + suffix.format(category.id)
+            self.assertEqual(int(after[name]) - int(before.get(name, 0)), 1)
+        self.assertGreater(float(after['feed_stage_seconds_sum{{category="{}",stage="merge"}}'.format(category.id)]), 0)
+        self.assertIn('feed_stage_seconds_count{stage="render",view="category-view"}', after)
+
+
+class StreamingTests(FeedTestCase):
+    """Category page is sent without waiting for feeds missing in cache,
+    their articles come later from the stream"""
+
+    def test_page_does_not_wait_for_missing_feeds(self):
+        category = self.create_category('news', 2)
+        self.cache_feeds(category)
+        category.sources.add(Source.objects.create(name="dead", link="http://127.0.0.1:9/rss"))
+        response = self.client.get('/category/{}'.format(category.id))
+        self.assertEqual(len(response.context['articles']), 2)
+        self.assertIn('/category/{}/stream?since='.format(category.id), response.context['stream_url'])
+
+        response = self.client.get('/category/{}/stream'.format(category.id))
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        events = b''.join(response.streaming_content).decode('utf-8').strip().split('\n\n')
+        self.assertTrue(events[0].startswith('event: articles'))
+        self.assertEqual(events[-1], 'event: done\ndata: []')
+        # failing source is backed off, so the next page does not wait for it
+        self.assertEqual(Source.objects.get(name="dead").failures, 1)
+        response = self.client.get('/category/{}'.format(category.id))
+        self.assertNotIn('stream_url', response.context)
+
+
+class DuplicateTests(TestCase):
+
+    def article(self, url, published, text):
+        return ArticleRecord(url, "", text, published, "example.com", simhash=simhash(tokenize(text)))
+
+    def test_merge_newest_skips_duplicates(self):
+        story = "Telescope captures image of distant galaxy, analysts warned experts the galaxy reacted"
+        feeds = [
+            [self.article("http://wire.example.org/galaxy", 3, story),
+             self.article("http://one.example.com/news/1", 1, "Parliament passes budget after long debate")],
+            [self.article("http://two.example.com/galaxy-story?utm_source=rss", 2, story + " Read more"),
+             self.article("http://two.example.com/news/1", 1, "Local team wins championship final at home"),
+             self.article("http://WIRE.example.org/galaxy/", 0, "Telescope")],
+        ]
+        self.assertEqual(
+            [a.url for a in merge_newest(feeds)],
+            ["http://wire.example.org/galaxy", "http://one.example.com/news/1", "http://two.example.com/news/1"]
+        )
+        self.assertEqual(len(merge_newest(feeds, limit=2)), 2)
+
+    def test_fingerprint_fits_database(self):
+        for fingerprint in (None, 0, (1 << 63) - 1, 1 << 63, (1 << 64) - 1):
+            signed = simhash_to_signed(fingerprint)
+            self.assertTrue(signed is None or -(1 << 63) <= signed < 1 << 63)
+            self.assertEqual(simhash_from_signed(signed), fingerprint)
+
+
+def sampled_urls(seed):
+    """Returns urls of not matching entries sampled by find_matching_entries, module level function,
+    so that it can run in other process"""
+    entries = [ArticleRecord("http://example.com/{}".format(number), "Local news {}".format(number),
+                             "", 1577872800 - number, "example.com") for number in range(100)]
+    return [entry.url for entry in find_matching_entries(entries, get_tag_matcher(["python"]), seed)]
+
+
+class SamplingTests(TestCase):
+
+    def test_sampling_is_deterministic(self):
+        urls = sampled_urls('')
+        self.assertTrue(0 < len(urls) < 100)
+        self.assertEqual(sampled_urls(''), urls)
+        # new interpreter has other hash randomization than this one
+        with ProcessPoolExecutor(2, mp_context=multiprocessing.get_context('spawn'),
+                                 initializer=django.setup) as executor:
+            self.assertEqual(list(executor.map(sampled_urls, ['', ''])), [urls, urls])
+        self.assertNotEqual(sampled_urls('other'), urls)
+
+
+class TagMatcherTests(TestCase):
+
+    def test_phrases_and_stemmed_words(self):
+        matcher = get_tag_matcher(["Machine Learning", "election"])
+        self.assertEqual(matcher.count(tokenize("Machine learning beats machine LEARNING benchmarks")), 2)
+        # words of the phrase have to follow each other
+        self.assertEqual(matcher.count(tokenize("Learning machine, machine for learning")), 0)
+        # words are compared by their stems
+        self.assertEqual(matcher.count(tokenize("Elections: the elected candidates")), 2)
+        self.assertEqual(matcher.count(tokenize("Machines learned in elections")), 2)
+
+    def test_matcher_is_reused_until_tags_change(self):
+        category = Category.objects.create(name="news")
+        category.search_tags.add(SearchTag.objects.create(name="Python"), SearchTag.objects.create(name="climate"))
+        view = CategoryView()
+        view.setup(RequestFactory().get('/'), id=category.id)
+        matcher = view.tag_matcher
+        self.assertIs(get_tag_matcher(["CLIMATE", "python", "Python"]), matcher)
+
+        category.search_tags.add(SearchTag.objects.create(name="security"))
+        view = CategoryView()
+        view.setup(RequestFactory().get('/'), id=category.id)
+        self.assertIsNot(view.tag_matcher, matcher)
+        self.assertEqual(view.tag_matcher.count(tokenize("Python security of climate models")), 3)
+
+
+class ParsingTests(TestCase):
+
+    def test_backends_give_the_same_records(self):
+        content = ''.join(
+            '<item><link>http://example.com/{0}</link><title>{1} news {0}</title>'
+            '<description>Release {0} of {1} brings faster builds and better errors</description>'
+            '<pubDate>Wed, 01 Jan 2020 {0:02d}:00:00 GMT</pubDate></item>'.format(number, name)
+            for number, name in enumerate(["Python", "Rust", "Python"])
+        )
+        content = '<rss version="2.0"><channel><ttl>60</ttl>{}</channel></rss>'.format(content).encode('utf-8')
+        results = []
+        for executor in (InlineExecutor(), ThreadPoolExecutor(1), ProcessPoolExecutor(1)):
+            with executor:
+                parsed_feed = executor.submit(
+                    parse_feed, content, {}, "http://example.com/rss", {1: ("python",)}
+                ).result()
+            results.append((
+                [(a.url, a.published, a.website, a.simhash) for a in parsed_feed.articles],
+                parsed_feed.matches, parsed_feed.feed, len(parsed_feed.entries)
+            ))
+        # both Python articles match the tag
+        self.assertTrue({0, 2} <= {index for index, _ in results[0][1][1]})
+        self.assertEqual(results[0][2], {'ttl': '60'})
+        self.assertEqual(results[1], results[0])
+        self.assertEqual(results[2], results[0])
+
+
+class SchedulerTests(TestCase):
+
+    def parsed_feed(self, hours_between, channel='', cache_control=''):
+        items = ''.join(
+            '<item><link>http://example.com/{0}</link><pubDate>Wed, 01 Jan 2020 {1:02d}:00:00 GMT</pubDate></item>'
+            .format(number, number * hours_between) for number in range(4)
+        )
+        return feedparser.parse(
+            '<rss version="2.0" xmlns:sy="http://purl.org/rss/1.0/modules/syndication/"><channel>{}{}</channel></rss>'
+            .format(channel, items), response_headers={'Cache-Control': cache_control}
+        )
+
+    def test_interval_adapts_to_feed(self):
+        now = timezone.now()
+        source = Source.objects.create(name="news", link="http://example.com/rss")
+        schedule(source, self.parsed_feed(2), True, now)
+        self.assertEqual((source.publish_interval, source.poll_interval), (2 * 3600, 3600))
+        self.assertEqual(source.next_poll, now + datetime.timedelta(hours=1))
+        schedule(source, self.parsed_feed(2), False, now)
+        self.assertEqual(source.poll_interval, 5400)
+        # publisher hints are never undercut
+        schedule(source, self.parsed_feed(2, '<ttl>180</ttl>'), True, now)
+        self.assertEqual(source.poll_interval, 3 * 3600)
+        schedule(source, self.parsed_feed(2, '<sy:updatePeriod>daily</sy:updatePeriod>'
+                                             '<sy:updateFrequency>2</sy:updateFrequency>'), True, now)
+        self.assertEqual(source.poll_interval, 12 * 3600)
+        schedule(source, self.parsed_feed(2, cache_control='public, max-age=14400'), True, now)
+        self.assertEqual(source.poll_interval, 4 * 3600)
+
+        schedule(source, None, False, now)
+        schedule(source, None, False, now)
+        self.assertEqual((source.failures, source.poll_interval), (2, 4 * 3600))
+        self.assertEqual(source.next_poll, now + datetime.timedelta(hours=16))
+        source.save()
+        self.assertEqual(get_due_sources(now + datetime.timedelta(hours=15)), [])
+        self.assertEqual(get_due_sources(now + datetime.timedelta(hours=16)), [source])
+        schedule(source, self.parsed_feed(2), True, now)
+        self.assertEqual((source.failures, source.poll_interval), (0, 3600))
+
+
+class SearchTests(FeedTestCase):
+
+    def test_search_articles(self):
+        category = self.create_category('news', 1)
+        source = category.sources.get()
+        titles = ["Python programmers meet", "Elections in Poland", "Programming python for elections"]
+        articles = [Article.objects.create(
+            source=source, url="http://example.com/{}".format(number), normalized_url="http://example.com/{}".format(number),
+            title=title, website="example.com", published=timezone.now() - datetime.timedelta(hours=number)
+        ) for number, title in enumerate(titles)]
+        CategoryArticle.objects.create(category=category, article=articles[2], published=articles[2].published)
+        index_articles(articles)
+
+        self.assertEqual(search_articles("python"), [articles[0], articles[2]])
+        self.assertEqual(search_articles("Elections PYTHON"), [articles[2]])
+        self.assertEqual(search_articles("python", category.id), [articles[2]])
+        self.assertEqual(search_articles("football"), [])
+        # count of postings of each word, postings, articles
+        with self.assertNumQueries(4):
+            search_articles("python programming")
+        response = self.client.get('/category/{}/search?q=programs'.format(category.id))
+        self.assertEqual([a['url'] for a in response.context['articles']], [articles[2].url])
+
+
+class ArticleApiTests(FeedTestCase):
+
+    def test_pages_and_polling(self):
+        category = self.create_category('news', 1)
+        source = category.sources.get()
+        published = timezone.now()
+        # articles published at the same time are ordered by id, also across pages
+        for number, hours in enumerate([0, 1, 1, 2, 3]):
+            article = Article.objects.create(
+                source=source, url="http://example.com/{}".format(number), normalized_url="http://example.com/{}".format(number),
+                title="Article {}".format(number), website="example.com",
+                published=published - datetime.timedelta(hours=hours)
+            )
+            CategoryArticle.objects.create(category=category, article=article, published=article.published)
+        url = '/api/category/{}/articles'.format(category.id)
+
+        titles = []
+        response = self.client.get(url, {'limit': 2})
+        while True:
+            data = response.json()
+            titles += [a['title'] for a in data['articles']]
+            if not data['next_cursor']:
+                break
+            response = self.client.get(url, {'limit': 2, 'cursor': data['next_cursor']})
+        self.assertEqual(titles, ["Article 0", "Article 2", "Article 1", "Article 3", "Article 4"])
+
+        response = self.client.get(url)
+        # unchanged articles are checked without queries apart from the category
+        with self.assertNumQueries(1):
+            self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag']).status_code, 304)
+        since = response.json()['since']
+        article = Article.objects.create(source=source, url="http://example.com/new", normalized_url="http://example.com/new",
+                                         title="New", website="example.com", published=published - datetime.timedelta(days=1))
+        CategoryArticle.objects.create(category=category, article=article, published=article.published)
+        # like ingest after commit
+        bump_page_version(category.id)
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag']).status_code, 200)
+        self.assertEqual([a['title'] for a in self.client.get(url, {'since': since}).json()['articles']], ["New"])
+        self.assertEqual(self.client.get(url, {'cursor': 'x'}).status_code, 400)
+
+
+class WebsiteHandler(BaseHTTPRequestHandler):
+    pages = {
+        '/': ('text/html', '<html><head><link rel="alternate" type="application/rss+xml" href="/news.rss">'
+                           '<link rel="alternate" type="application/rss+xml" href="/missing.rss"></head>'
+                           '<body><a href="/other.xml">Other</a></body></html>'),
+        '/news.rss': ('text/xml', '<?xml version="1.0"?><rss version="2.0"><channel><item><title>Python news</title>'
+                                  '<link>http://example.com/python</link><description>About python releases and their new features</description>'
+                                  '</item></channel></rss>'),
+        '/feed': ('application/atom+xml', '<feed xmlns="http://www.w3.org/2005/Atom"></feed>'),
+        '/rss': ('text/html', '<html><body>Not a feed</body></html>'),
+        '/slow.rss': ('text/xml', '<?xml version="1.0"?><rss version="2.0"><channel></channel></rss>'),
+    }
+    # seconds after which page is sent
+    delays = {'/slow.rss': 1}
+    etags = {'/news.rss': '"news-1"'}
+    # path redirected to another host, like articles served through feed proxies
+    redirects = {'/proxy/python': 'http://localhost:{port}/news.rss'}
+    requests = []
+
+    def do_HEAD(self):
+        self.requests.append('HEAD ' + self.path)
+        path = urlsplit(self.path).path
+        if path in self.redirects:
+            self.send_response(301)
+            self.send_header('Location', self.redirects[path].format(port=self.server.server_address[1]))
+        elif path in self.pages:
+            self.send_response(200)
+            self.send_header('Content-Type', self.pages[path][0])
+        else:
+            self.send_response(404)
+        self.end_headers()
+
+    def do_GET(self):
+        self.requests.append(self.path)
+        # proxy requests have absolute url as path
+        path = urlsplit(self.path).path
+        if path not in self.pages:
+            self.send_error(404)
+            return
+        content_type, body = self.pages[path]
+        time.sleep(self.delays.get(path, 0))
+        etag = self.etags.get(path)
+        if etag and self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        if etag:
+            self.send_header('ETag', etag)
+        self.end_headers()
+        self.wfile.write(body.encode('utf-8'))
+
+    def log_message(self, *args):
+        pass
+
+
+class WebsiteTestCase(FeedTestCase):
+    """Runs local website served by WebsiteHandler"""
+
+    def setUp(self):
+        super().setUp()
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), WebsiteHandler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.website = "http://127.0.0.1:{}/".format(self.server.server_address[1])
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class SharedFeedTests(WebsiteTestCase):
+    """Feed subscribed by many categories has one source and is downloaded once"""
+
+    def test_feed_is_shared_by_categories(self):
+        categories = [self.create_category(name, 0, tags_count=0) for name in ('news', 'tech')]
+        python = SearchTag.objects.create(name="python")
+        for category in categories:
+            category.search_tags.add(python)
+            self.client.post('/category/{}/source/new'.format(category.id),
+                             {'name': "News", 'link': self.website + "news.rss"})
+        source = Source.objects.get()
+        self.assertEqual([c.sources.get() for c in categories], [source, source])
+
+        cache.clear()
+        downloads = WebsiteHandler.requests.count('/news.rss')
+        for category in categories:
+            response = self.client.get('/category/{}/stream'.format(category.id))
+            self.assertIn("Python news", b''.join(response.streaming_content).decode('utf-8'))
+        self.assertEqual(WebsiteHandler.requests.count('/news.rss'), downloads + 1)
+
+
+class SourceMigrationTests(TransactionTestCase):
+    """Sources of the same feed saved before normalized_link existed are merged by migrations"""
+
+    def migrate(self, target):
+        executor = MigrationExecutor(connection)
+        executor.migrate([('feed', target)])
+        return executor.loader.project_state(('feed', target)).apps
+
+    def tearDown(self):
+        self.migrate('0004_source_normalized_link_unique')
+
+    def test_duplicate_sources_are_merged(self):
+        apps = self.migrate('0001_initial')
+        OldSource, OldCategory, OldArticle = (
+            apps.get_model('feed', name) for name in ('Source', 'Category', 'Article')
+        )
+        sources = [OldSource.objects.create(name="News", link=link) for link in (
+            "http://example.com/news.rss", "HTTP://Example.com/news.rss/", "http://example.com/other.rss"
+        )]
+        categories = [OldCategory.objects.create(name=name) for name in ('news', 'tech')]
+        categories[0].sources.add(sources[0], sources[2])
+        categories[1].sources.add(sources[1])
+        OldArticle.objects.create(source=sources[1], url="http://example.com/1", normalized_url="example.com/1",
+                               title="Article", website="example.com", published=timezone.now())
+
+        self.migrate('0004_source_normalized_link_unique')
+        self.assertEqual(list(Source.objects.values_list('id', 'normalized_link').order_by('id')), [
+            (sources[0].id, normalize_url("http://example.com/news.rss")),
+            (sources[2].id, normalize_url("http://example.com/other.rss")),
+        ])
+        self.assertEqual([list(Category.objects.get(id=c.id).sources.values_list('id', flat=True).order_by('id'))
+                          for c in categories],
+                         [[sources[0].id, sources[2].id], [sources[0].id]])
+        self.assertEqual(list(Article.objects.values_list('source_id', flat=True)), [sources[0].id])
+
+
+class ResolveWebsitesTests(WebsiteTestCase):
+    """Articles served through feed proxies get website of the host they are redirected to"""
+
+    def proxied_entries(self):
+        return [
+            ArticleRecord(self.website + "proxy/python", "Python news", "", 1577872800, "rss.example.com"),
+            # nothing listens on port 1
+            ArticleRecord("http://127.0.0.1:1/proxy/other", "Other news", "", 1577872800, "feedproxy.example.com"),
+        ]
+
+    def test_websites_are_resolved_and_cached(self):
+        entries = resolve_websites(self.proxied_entries())
+        self.assertEqual(entries[0].website, "localhost:{}".format(self.server.server_address[1]))
+        # failed HEAD request keeps website of the feed
+        self.assertEqual(entries[1].website, "feedproxy.example.com")
+
+        heads = [path for path in WebsiteHandler.requests if path.startswith('HEAD')]
+        entries = resolve_websites(self.proxied_entries())
+        self.assertEqual(entries[0].website, "localhost:{}".format(self.server.server_address[1]))
+        self.assertEqual([path for path in WebsiteHandler.requests if path.startswith('HEAD')], heads)
+
+    def test_websites_of_feeds_are_resolved_in_one_batch(self):
+        links = [self.website + "news.rss", self.website + "feed"]
+        with mock.patch('feed.shared_feeds.resolve_websites') as resolve:
+            fetch_shared_feeds(links)
+        self.assertEqual(resolve.call_count, 1)
+
+
+class BackgroundRefreshTests(WebsiteTestCase):
+    """Stale records are shown right away and refreshed in background by one request"""
+
+    def test_stale_record_is_served_while_refreshed_once(self):
+        category = self.create_category('news', 0, tags_count=0)
+        category.search_tags.add(SearchTag.objects.create(name="python"))
+        link = self.website + "news.rss"
+        category.sources.add(Source.objects.create(name="News", link=link))
+        keys = feed_keys(category.id, [link])
+        set_feeds(keys, {link: FeedRecord(
+            [ArticleRecord("http://example.com/old", "Old news", "", 1577872800, "example.com")],
+            '', '', time.time() - 24 * 60 * 60
+        )})
+        url = '/category/{}'.format(category.id)
+        downloads = WebsiteHandler.requests.count('/news.rss')
+        with mock.patch.dict(WebsiteHandler.delays, {'/news.rss': 1}):
+            for _ in range(3):
+                start = time.monotonic()
+                response = self.client.get(url)
+                self.assertLess(time.monotonic() - start, 0.5)
+                self.assertContains(response, "Old news")
+            deadline = time.monotonic() + 5
+            while not is_fresh(get_feeds(keys)[link]) and time.monotonic() < deadline:
+                time.sleep(0.05)
+        # lock taken with cache.add lets only the first request refresh the feed
+        self.assertEqual(WebsiteHandler.requests.count('/news.rss'), downloads + 1)
+        self.assertContains(self.client.get(url), "Python news")
+
+
+@override_settings(CACHES=test_caches)
+class BackgroundRefreshFailureTests(TransactionTestCase):
+    """Failures of background refresh are recorded, so that the feed backs off like after failed download"""
+
+    def setUp(self):
+        cache.clear()
+
+    def test_failed_refresh_backs_off(self):
+        category = Category.objects.create(name="news")
+        category.search_tags.add(SearchTag.objects.create(name="python"))
+        # nothing listens on port 1
+        source = Source.objects.create(name="News", link="http://127.0.0.1:1/news.rss")
+        category.sources.add(source)
+        set_feeds(feed_keys(category.id, [source.link]), {source.link: FeedRecord(
+            [ArticleRecord("http://example.com/old", "Old news", "", 1577872800, "example.com")],
+            '', '', time.time() - 24 * 60 * 60
+        )})
+        url = '/category/{}'.format(category.id)
+        self.assertContains(self.client.get(url), "Old news")
+        deadline = time.monotonic() + 5
+        while not Source.objects.get(id=source.id).failures and time.monotonic() < deadline:
+            time.sleep(0.05)
+        source.refresh_from_db()
+        self.assertEqual(source.failures, 1)
+        self.assertGreater(source.next_poll, timezone.now())
+
+        cache.delete(page_key(category.id))
+        with mock.patch('feed.views.refresh_in_background') as refresh:
+            self.assertContains(self.client.get(url), "Old news")
+        self.assertEqual(refresh.call_args[0][1], [])
+
+
+class StreamDisconnectTests(WebsiteTestCase):
+
+    def read_first_articles(self, category):
+        """:returns
+        seconds after which stream of category sent first articles, stream is closed right after"""
+        start = time.monotonic()
+        response = self.client.get('/category/{}/stream'.format(category.id))
+        try:
+            for event in response.streaming_content:
+                if event.startswith(b'event: articles'):
+                    return time.monotonic() - start
+        finally:
+            response.close()
+
+    def test_closed_stream_does_not_slow_down_next_one(self):
+        category = self.create_category('news', 0, tags_count=0)
+        category.search_tags.add(SearchTag.objects.create(name="python"))
+        category.sources.add(Source.objects.create(name="News", link=self.website + "news.rss"))
+        # 20 slow feeds of the same host take 10 s with 2 requests per host
+        for number in range(20):
+            category.sources.add(Source.objects.create(name="Slow", link=self.website + "slow.rss?{}".format(number)))
+        requests_count = len(WebsiteHandler.requests)
+        self.assertLess(self.read_first_articles(category), 1)
+        # downloads of closed stream which did not start are cancelled
+        cache.clear()
+        self.assertLess(self.read_first_articles(category), 2.5)
+        time.sleep(1)
+        slow_requests = [path for path in WebsiteHandler.requests[requests_count:] if path.startswith('/slow.rss')]
+        self.assertLessEqual(len(slow_requests), 4)
+
+
+class IngestTests(WebsiteTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.category = self.create_category('news', 0, tags_count=0)
+        self.category.search_tags.add(SearchTag.objects.create(name="python"))
+        self.category.sources.add(Source.objects.create(name="News", link=self.website + "news.rss"))
+
+    def test_fingerprints_are_stored(self):
+        self.assertEqual(ingest_sources(get_due_sources()), 1)
+        article = Article.objects.get()
+        fingerprint = simhash(tokenize(article.summary) + tokenize(article.title))
+        self.assertIsNotNone(fingerprint)
+        self.assertEqual(simhash_from_signed(article.simhash), fingerprint)
+        response = self.client.get('/category/{}'.format(self.category.id))
+        self.assertEqual([a.simhash for a in response.context['articles']], [fingerprint])
+
+    def test_feeds_not_fetched_in_time_stay_due(self):
+        for name in ("slow.rss", "missing.rss"):
+            self.category.sources.add(Source.objects.create(name=name, link=self.website + name))
+        with mock.patch('feed.ingest.batch_deadline', return_value=0.5):
+            self.assertEqual(ingest_sources(get_due_sources()), 1)
+        sources = {source.name: source for source in Source.objects.all()}
+        self.assertEqual(sources["missing.rss"].failures, 1)
+        self.assertEqual((sources["slow.rss"].failures, sources["slow.rss"].next_poll), (0, None))
+        self.assertEqual(sources["News"].failures, 0)
+        self.assertEqual(get_due_sources(), [sources["slow.rss"]])
+
+    def test_category_subscribing_later_gets_stored_articles(self):
+        self.assertEqual(ingest_sources(get_due_sources()), 1)
+        source = Source.objects.get()
+        self.assertEqual(source.etag, '"news-1"')
+        other = self.create_category('tech', 0, tags_count=0)
+        other.search_tags.add(SearchTag.objects.create(name="python"))
+        other.sources.add(source)
+        Source.objects.update(next_poll=None)
+        self.assertEqual(ingest_sources(get_due_sources()), 0)
+        self.assertEqual(CategoryArticle.objects.filter(category=other).count(), 1)
+        self.assertEqual(CategoryArticle.objects.filter(category=self.category).count(), 1)
+
+    def test_batch_deadline(self):
+        links = ["http://{}.example.com/rss".format(number) for number in range(20)]
+        self.assertEqual(batch_deadline(links[:3], 10), 10)
+        # 16 workers
+        self.assertEqual(batch_deadline(links, 10), 20)
+        # 2 requests per host
+        self.assertEqual(batch_deadline(["http://example.com/{}".format(number) for number in range(5)], 10), 30)
+
+    def test_not_modified_feed_is_reused(self):
+        link = self.website + "news.rss"
+        keys = shared_feed_keys([link])
+        previous = store_shared_feed(keys, link, fetch_feed(link))
+        self.assertEqual(previous.etag, '"news-1"')
+        parsed_feed = fetch_feed(link, etag=previous.etag)
+        self.assertEqual(parsed_feed.status, 304)
+        self.assertIs(store_shared_feed(keys, link, parsed_feed, previous).entries, previous.entries)
+
+        self.assertEqual(ingest_sources(get_due_sources()), 1)
+        self.assertEqual(Source.objects.get().etag, '"news-1"')
+        Source.objects.update(next_poll=None)
+        with mock.patch('feed.ingest.store_articles') as store_articles:
+            self.assertEqual(ingest_sources(get_due_sources()), 0)
+        store_articles.assert_not_called()
+        self.assertEqual(Article.objects.count(), 1)
+
+
+class DiscoveryTests(WebsiteTestCase):
+
+    def test_discover_feeds(self):
+        feeds = discover_feeds(self.website)
+        self.assertEqual(feeds, [self.website + "news.rss", self.website + "feed"])
+        # body links are not needed when head declares feeds, results are cached
+        requests_count = len(WebsiteHandler.requests)
+        self.assertNotIn('/other.xml', WebsiteHandler.requests)
+        self.assertEqual(discover_feeds(self.website), feeds)
+        # other page of the same host
+        self.assertEqual(discover_feeds(self.website + "news.rss"), feeds)
+        self.assertEqual(len(WebsiteHandler.requests), requests_count)
+
+    def test_discovery_takes_at_most_timeout(self):
+        start = time.monotonic()
+        with mock.patch.dict(WebsiteHandler.delays, {'/': 1, '/news.rss': 1}):
+            for discover in (discover_feeds, async_to_sync(async_fetcher.discover_feeds)):
+                cache.clear()
+                # feed declared by homepage is validated too late
+                self.assertEqual(discover(self.website, timeout=1.5), [self.website + "feed"])
+                self.assertLess(time.monotonic() - start, 1.9)
+                start = time.monotonic()
+
+    def test_failed_homepage_is_closed(self):
+        response = mock.Mock()
+        response.raise_for_status.side_effect = requests.HTTPError("404 Client Error")
+        with mock.patch('feed.discovery.session.get', return_value=response):
+            with self.assertRaises(requests.HTTPError):
+                find_feed_links(self.website)
+        response.close.assert_called_once_with()
+
+
+class SourceImportTests(WebsiteTestCase):
+
+    def test_source_is_validated_before_save(self):
+        category = self.create_category('news', 0)
+        response = self.client.post('/category/{}/source/new'.format(category.id),
+                                    {'name': "Not a feed", 'link': self.website + "rss"})
+        self.assertFormError(response, 'form', 'link', "To nie jest feed RSS!")
+        self.assertFalse(Source.objects.exists())
+
+        link = self.website + "news.rss"
+        self.client.post('/category/{}/source/new'.format(category.id), {'name': "News", 'link': link})
+        self.assertEqual([source.link for source in category.sources.all()], [link])
+        self.assertIn(link, get_feeds(feed_keys(category.id, [link])))
+
+    def test_opml_import_and_export(self):
+        existing = self.create_category('Tech', 0)
+        opml = """<?xml version="1.0"?><opml version="2.0"><body>
+            <outline text="Tech"><outline type="rss" text="News" xmlUrl="{0}news.rss"/>
+            <outline type="rss" text="Broken" xmlUrl="{0}rss"/>
+            <outline type="rss" text="Missing" xmlUrl="{0}missing.rss"/></outline>
+            <outline text="World"><outline type="rss" text="News" xmlUrl="{0}news.rss"/></outline>
+            </body></opml>""".format(self.website).encode('utf-8')
+        links = [self.website + "missing.rss", self.website + "news.rss", self.website + "rss"]
+        # feeds not fetched in time are reported apart from broken ones
+        with mock.patch('feed.opml.IMPORT_TIMEOUT', 0):
+            self.assertEqual(import_feeds(parse_opml(opml)), (0, 0, [], [], links))
+        self.assertFalse(Source.objects.exists())
+        result = import_feeds(parse_opml(opml))
+        self.assertEqual(result, (2, 0, [self.website + "missing.rss"], [self.website + "rss"], []))
+        self.assertEqual(Source.objects.count(), 1)
+        self.assertEqual(existing.sources.get().name, "News")
+        self.assertEqual(Category.objects.get(name="World").sources.get().link, self.website + "news.rss")
+        self.assertEqual(import_feeds(parse_opml(opml)).existing, 2)
+
+        exported = self.client.get('/source/opml/export').content
+        self.assertEqual(
+            sorted(parse_opml(exported)),
+            [("Tech", "News", self.website + "news.rss"), ("World", "News", self.website + "news.rss")]
+        )
+
+
+class AsyncHandlerTests(WebsiteTestCase):
+    """Feeds are downloaded on the event loop by FeedASGIHandler"""
+
+    def setUp(self):
+        super().setUp()
+        # like test client, connection of the test has to stay open between requests
+        signals.request_started.disconnect(close_old_connections)
+        signals.request_finished.disconnect(close_old_connections)
+
+    def tearDown(self):
+        signals.request_started.connect(close_old_connections)
+        signals.request_finished.connect(close_old_connections)
+        super().tearDown()
+
+    def asgi_get(self, path, disconnect_after=None):
+        """:argument
+        disconnect_after - seconds after which client disconnects, it waits till the end when None"""
+        messages = []
+        received = []
+
+        async def receive():
+            if not received:
+                received.append(True)
+                return {'type': 'http.request'}
+            if disconnect_after is None:
+                await asyncio.Future()
+            await asyncio.sleep(disconnect_after)
+            return {'type': 'http.disconnect'}
+
+        async def send(message):
+            messages.append(message)
+
+        scope = {'type': 'http', 'method': 'GET', 'path': path, 'query_string': b'',
+                 'headers': [(b'host', b'testserver')]}
+        async_to_sync(FeedASGIHandler())(scope, receive, send)
+        return messages[0]['status'], b''.join(message.get('body', b'') for message in messages[1:]).decode('utf-8')
+
+    def test_category_feeds_are_downloaded_before_view(self):
+        category = Category.objects.create(name="news")
+        category.search_tags.add(SearchTag.objects.create(name="python"))
+        category.sources.add(Source.objects.create(name="news", link=self.website + "news.rss"))
+        path = '/category/{}'.format(category.id)
+        with mock.patch.object(CategoryView, 'streaming', False):
+            status, page = self.asgi_get(path)
+        self.assertEqual(status, 200)
+        self.assertIn("Python news", page)
+        self.assertNotIn("/stream", page)
+
+        # in streaming mode page does not wait for feeds, stream downloads them
+        cache.clear()
+        downloads = WebsiteHandler.requests.count('/news.rss')
+        status, page = self.asgi_get(path)
+        self.assertIn("/stream", page)
+        self.assertEqual(WebsiteHandler.requests.count('/news.rss'), downloads)
+        status, stream = self.asgi_get(path + '/stream')
+        events = stream.strip().split('\n\n')
+        self.assertTrue(events[0].startswith('event: articles') and "Python news" in events[0])
+        self.assertEqual(events[-1], 'event: done\ndata: []')
+
+    def test_disconnected_stream_stops_downloads(self):
+        category = Category.objects.create(name="news")
+        category.search_tags.add(SearchTag.objects.create(name="python"))
+        link = self.website + "slow.rss"
+        category.sources.add(Source.objects.create(name="slow", link=link))
+        start = time.monotonic()
+        with mock.patch.dict(WebsiteHandler.delays, {'/slow.rss': 3}):
+            self.asgi_get('/category/{}/stream'.format(category.id), disconnect_after=0.2)
+        self.assertLess(time.monotonic() - start, 2)
+        # lock of the feed was released, next request downloads it
+        self.assertEqual(lock_feeds(feed_keys(category.id, [link]), [link]), [link])
+
+    def test_discover_feeds(self):
+        feeds = async_to_sync(async_fetcher.discover_feeds)(self.website)
+        self.assertEqual(feeds, [self.website + "news.rss", self.website + "feed"])
+
+    def test_feeds_are_fetched_through_proxy(self):
+        link = "http://feeds.invalid/news.rss"
+        with mock.patch.dict(os.environ, {'HTTP_PROXY': self.website, 'NO_PROXY': ''}):
+            feeds = async_to_sync(async_fetcher.fetch_feeds)([link])
+        self.assertEqual([article.title for article in feeds[link].articles], ["Python news"])
+        self.assertEqual(WebsiteHandler.requests[-1], link)
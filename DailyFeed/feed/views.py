@@ -1,158 +1,303 @@
-import datetime
-from urllib.parse import urlparse
 import json
-import itertools
-import re
 import time
-import random
-import feedparser
-import pdb
-from bs4 import BeautifulSoup
-import requests
-from nltk.stem import PorterStemmer
-
-from django.shortcuts import render, redirect
+from functools import partial
+
+from django.shortcuts import render, redirect, get_object_or_404
 from django.views import View
 from django.views.generic import TemplateView
 from django.views.generic.edit import CreateView, DeleteView
-from django.core.cache import cache
+from django.conf import settings
 from django.urls import reverse_lazy
-from django.http import JsonResponse
-from .models import Category, Source, SearchTag
-from .forms import SourceForm, FindSourceForm, DiscoveredSourceForm, TagFormset
-from .source_builder import check_if_source_exists
-
-html_cleaner_regex = re.compile('<.*?>')
-
-porter = PorterStemmer()
-
-class GeneralView(TemplateView):
+from django.http import JsonResponse, HttpResponse, StreamingHttpResponse
+from django.utils.cache import get_conditional_response
+from django.utils.functional import cached_property
+from django.views.decorators.http import require_GET
+from django.db.models import prefetch_related_objects
+from .models import Category, Source, SearchTag, CategoryArticle
+from .forms import SourceForm, FindSourceForm, DiscoveredSourceForm, TagFormset, OpmlImportForm
+from .source_builder import check_if_source_exists, get_sources
+from .search import search_articles
+from .api import default_page_size, max_page_size, decode_cursor, articles_etag, newest_article_id, get_articles_page
+from .discovery import discover_feeds
+from .opml import parse_opml, render_opml, import_feeds
+from .metrics import timed, increment, render_metrics
+from .fetcher import fetch_feed
+from .shared_feeds import fetch_shared_feeds, iter_shared_feeds, shared_feed_keys, store_shared_feed
+from .feed_cache import FeedRecord, feed_keys, get_feeds, set_feeds, build_feeds, iter_build_feeds, is_fresh, \
+    refresh_in_background, bump_versions_on_commit, bump_category_version, bump_source_version, bump_page_version, \
+    bump_pages_version, get_page, set_page, FRESH_TIME, CACHE_TIME
+from .scheduler import is_backing_off, record_attempts, record_background_attempts
+from .pipeline import ArticleRecord, find_matching_entries, get_tag_matcher, get_date, article_order, merge_newest, \
+    unique_entries, simhash_from_signed, near_duplicate_distance
+
+class CategoriesMixin:
+    """Adds categories for navigation bar, loaded once per request"""
+
+    @cached_property
+    def categories(self):
+        return list(Category.objects.all())
 
     def get_context_data(self, **kwargs):
-        context = super(GeneralView, self).get_context_data(**kwargs)
-        context['categories'] = Category.objects.all()
+        context = super().get_context_data(**kwargs)
+        context['categories'] = self.categories
         return context
 
 
+class GeneralView(CategoriesMixin, TemplateView):
+    pass
+
+
 class IndexView(GeneralView):
     http_method_names = ['get']
     template_name = "index.html"
 
 class CategoryView(GeneralView):
+    """Rendered page is cached until its dependencies change (see feed_cache.get_page) or
+    its first feed gets stale, so that page of category which did not change needs single cache read"""
     http_method_names = ['get']
     template_name = "category/articles.html"
+    streaming = getattr(settings, 'FEED_STREAMING', True)
+    # seconds for which rendered page may be cached, set while articles are read, None when it may not
+    page_timeout = None
+
+    def get(self, request, *args, **kwargs):
+        category_id = kwargs['id']
+        with timed('page', category=category_id):
+            version, content = get_page(category_id)
+        increment('feed_page_total', category=category_id, result='hit' if content is not None else 'miss')
+        if content is not None:
+            return HttpResponse(content)
+        response = super().get(request, *args, **kwargs)
+        response.add_post_render_callback(lambda rendered: self.save_page(category_id, version, rendered))
+        return response
+
+    def save_page(self, category_id, version, response):
+        if self.page_timeout and response.status_code == 200:
+            set_page(category_id, version, response.content, self.page_timeout)
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
-        category = Category.objects.get(id=kwargs['id'])
-        all_articles = self.get_articles(category.id)
+        category = self.category
+        self.pending_links = []
+        all_articles = self.get_articles(category)
         context['category'] = category
-        context['no_of_sources'] = category.sources.count()
+        context['no_of_sources'] = len(category.sources.all())
         context['articles'] = all_articles
+        if self.pending_links:
+            context['stream_url'] = "{}?since={}".format(
+                reverse_lazy('category-stream', kwargs={'id': category.id}), self.page_time)
+            context['near_duplicate_distance'] = near_duplicate_distance
         return context
 
-    def get_articles(self, category_id):
-        category = Category.objects.get(id=category_id)
-        best_articles_grouped = []
+    @cached_property
+    def category(self):
+        return Category.objects.prefetch_related('sources', 'search_tags').get(id=self.kwargs['id'])
+
+    def get_articles(self, category):
+        """category - Category with prefetched sources and search_tags, see self.category.
+        In streaming mode feeds missing in cache are not downloaded, their links are left
+        in self.pending_links for CategoryStreamView"""
+        category_id = category.id
+        with timed('query', category=category_id):
+            stored_articles = self.get_stored_articles(category_id)
+        if stored_articles:
+            # changes only with ingest, which bumps page version
+            self.page_timeout = CACHE_TIME
+            return stored_articles
         sources = category.sources.all()
-        start = time.time()
-        for site in sources:
-            try_cache = cache.get("cache_{}".format(site.link))
-            site_category_articles = try_cache or self.scrape_xml_feed(site.link)
-            if not try_cache:
-                cache.set("cache_{}".format(site.link), json.dumps(site_category_articles), 5*60)
-
-            if isinstance(site_category_articles, str):
-                site_category_articles = json.loads(site_category_articles)
-            try_cache_formatted = cache.get("formatted_{}".format(site.link))
-
-            site_category_articles = try_cache_formatted or self.format_entries(site_category_articles)
-            if not try_cache_formatted:
-                cache.set("formatted_{}".format(site.link), json.dumps(site_category_articles), 10 * 60)
-            if isinstance(site_category_articles, str):
-                site_category_articles = json.loads(site_category_articles)
-            best_articles_grouped.append(site_category_articles)
-
-        print("MINELO: ", round(time.time() - start, 3))
-        best_articles = list(itertools.chain(*best_articles_grouped))
-        best_articles = self.delete_duplicate_articles(best_articles)
-        best_articles = sorted(best_articles, key=lambda l: l['published'], reverse=True)
-        no_of_articles = len(best_articles) - 1
-        best_articles = best_articles[:100] or best_articles[:no_of_articles] or []
-        best_articles = self.make_date_clear(best_articles)
-
-        print("ZAKONCZONO: ", round(time.time() - start, 3))
-        return best_articles
-
-    def scrape_xml_feed(self, source_link):
-        print(source_link)
-        current_year = datetime.datetime.today().year
-        parsed_feed = feedparser.parse(source_link)
-        entries = parsed_feed.entries
-        entries = self.find_matching_entries(entries)
-        last_entries = entries[:50] or entries[:abs(len(entries) - 1)]
-        last_entries = [
-                        {'url': getattr(e, 'link', '----'),
-                         'title': getattr(e, 'title', '----'),
-                         'summary': re.sub(html_cleaner_regex, ' ', getattr(e, 'summary', '-----')),
-                         'published': self.get_date(e),
-                         'website': urlparse(getattr(parsed_feed, 'link', getattr(e, 'link',  getattr(parsed_feed, 'href', "unknown")))).netloc
-                         } for e in last_entries]
-        last_entries = [e for e in last_entries if current_year - int(e.get('published').tm_year <= 1)]
-        return last_entries
+        keys, feed_records = self.get_cached_feeds(category)
+        missing_sources = [site for site in sources if site.link not in feed_records]
+        if missing_sources:
+            self.page_timeout = None
+        increment('feed_cache_total', len(missing_sources), category=category_id, result='miss')
+        missing_links = [site.link for site in missing_sources if not is_backing_off(site)]
+        if self.streaming:
+            self.pending_links = missing_links
+        else:
+            built_records = build_feeds(keys, missing_links, self.refresh_feeds)
+            feed_records.update(built_records)
+            record_attempts([site for site in missing_sources if site.link in missing_links], built_records)
+        best_articles_grouped = [feed_records[site.link].entries for site in sources if site.link in feed_records]
+        with timed('merge', category=category_id):
+            return self.newest_articles(best_articles_grouped)
+
+    def get_cached_feeds(self, category):
+        """Reads cached feeds of category and starts background refresh of stale ones,
+        record is stale after poll interval of its source (at least FEED_CACHE_FRESH_TIME),
+        feeds which keep failing (also in background refresh) are not refreshed until their backoff passes
+        :returns
+        (dictionary {link: cache key}, dictionary {link: FeedRecord} of cached feeds)"""
+        category_id = category.id
+        sources = category.sources.all()
+        with timed('cache', category=category_id):
+            keys = feed_keys(category_id, [site.link for site in sources])
+            feed_records = get_feeds(keys)
+        self.page_time = now = time.time()
+        fresh_times = {site.link: max(FRESH_TIME, site.poll_interval) for site in sources}
+        stale_sources = [site for site in sources if site.link in feed_records
+                         and not is_fresh(feed_records[site.link], now, fresh_times[site.link])
+                         and not is_backing_off(site)]
+        stale_links = [site.link for site in stale_sources]
+        # page is cached until its first feed gets stale
+        self.page_timeout = max(0, int(min(
+            (record.fetched + fresh_times[link] - now for link, record in feed_records.items()), default=CACHE_TIME
+        )))
+        increment('feed_cache_total', len(feed_records) - len(stale_links), category=category_id, result='hit')
+        increment('feed_cache_total', len(stale_links), category=category_id, result='stale')
+        # matcher has to be ready before background refresh, which must not query database
+        self.tag_matcher
+        refresh_in_background(keys, stale_links, self.refresh_feeds, partial(record_background_attempts, stale_sources))
+        return keys, feed_records
+
+    def newest_articles(self, articles_grouped):
+        """Returns at most 100 newest articles, template formats their dates, see ArticleRecord
+        :argument
+        articles_grouped - lists of articles of feeds, each sorted newest first"""
+        return merge_newest(articles_grouped, 100)
+
+    def refresh_feeds(self, links):
+        """Builds new cache records of given feeds, feeds are downloaded only when
+        no other category did it recently, see shared_feeds
+        :returns
+        dictionary {link: FeedRecord} for feeds downloaded successfully"""
+        with timed('fetch', category=self.kwargs.get('id', None)):
+            shared_feeds = fetch_shared_feeds(links)
+        return self.build_records(shared_feeds)
+
+    def build_records(self, shared_feeds):
+        """Builds cache records of category from feeds shared by all categories
+        :argument
+        shared_feeds - dictionary {link: SharedFeed}
+        :returns
+        dictionary {link: FeedRecord}"""
+        return {link: self.build_record(link, shared_feed) for link, shared_feed in shared_feeds.items()}
+
+    def iter_refresh_feeds(self, links):
+        """Same as refresh_feeds, but yields (link, FeedRecord) as soon as each feed is downloaded"""
+        for link, shared_feed in iter_shared_feeds(links):
+            yield link, self.build_record(link, shared_feed)
+
+    def build_record(self, link, shared_feed):
+        """Same as build_records, for single feed"""
+        entries = self.scrape_xml_feed(link, shared_feed.entries)
+        return FeedRecord(entries, shared_feed.etag, shared_feed.modified, shared_feed.fetched)
+
+    def get_missing_sources(self):
+        """Used by FeedASGIHandler, which downloads feeds before the view runs
+        :returns
+        (dictionary {link: cache key}, sources of category without cached feed, apart from
+        those backing off after failures), no sources when category has stored articles"""
+        category = self.category
+        if CategoryArticle.objects.filter(category_id=category.id).exists():
+            return {}, []
+        keys = feed_keys(category.id, [site.link for site in category.sources.all()])
+        feed_records = get_feeds(keys)
+        # matcher has to be ready before records are built outside of database thread
+        self.tag_matcher
+        return keys, [site for site in category.sources.all()
+                      if site.link not in feed_records and not is_backing_off(site)]
+
+    def get_stored_articles(self, category_id):
+        """Returns newest articles saved by ingest_feeds command, empty list when
+        feeds of this category were not ingested yet. More articles are read,
+        so that 100 are left after removing the same stories of other sites, whose fingerprints
+        were stored by ingest"""
+        category_articles = CategoryArticle.objects.filter(category_id=category_id)\
+            .select_related('article').order_by('-published', '-relevance')[:200]
+        return unique_entries((
+            ArticleRecord(ca.article.url, ca.article.title, ca.article.summary, int(ca.published.timestamp()),
+                          ca.article.website, ca.relevance, simhash_from_signed(ca.article.simhash))
+            for ca in category_articles), 100)
+
+    def scrape_xml_feed(self, source_link, entries):
+        """Returns newest entries of feed matching tags of category
+        :argument
+        entries - entries of feed shared by all categories, as returned by parse_entries. Matching
+        sets their relevance in place, every request reads its own copy of them from cache"""
+        with timed('match', histogram='feed_source_seconds', source=source_link):
+            entries = self.find_matching_entries(entries)
+        entries.sort(key=article_order, reverse=True)
+        return entries[:50]
+
+    @cached_property
+    def tag_matcher(self):
+        return get_tag_matcher([t.name for t in self.category.search_tags.all()])
 
     def find_matching_entries(self, entries):
-        category_id = self.kwargs.get('id', None)
-        category = Category.objects.get(id=category_id)
-        add_treshold = 0.8
-        category_tags = category.search_tags.all()
-        treshold_decrease = 1.0/(len(entries) + 1)
-        matching_entries = []
-        for entry in entries:
-            summary = [porter.stem(w) for w in (re.sub(html_cleaner_regex, ' ', entry.summary.lower()).split() + re.sub(html_cleaner_regex, ' ', entry.title.lower()).split())]
-            if any([t.name.lower() in summary for t in category_tags]) and entry.title != '':
-                matching_entries.append(entry)
-            else:
-                chance = random.random()
-                if chance > add_treshold:
-                    matching_entries.append(entry)
-            add_treshold -= treshold_decrease
-        return matching_entries
-
-
-    def format_entries(self, entries):
-        urls_to_reparse = ['feedproxy', 'rss']
-        for entry in entries:
-            date_published = time.struct_time(tuple(entry.get('published'))) if isinstance(entry.get('published'), list) else entry.get('published')
-            entry['published'] = time.strftime('%Y-%m-%dT%H:%M:%SZ', date_published)
-            if any([entry.get('website',' ').startswith(url) for url in urls_to_reparse]):
-                article = requests.get(entry.get('url'))
-                entry['website'] = urlparse(article.url).netloc
-        return entries
+        return find_matching_entries(entries, self.tag_matcher, getattr(settings, 'FEED_SAMPLING_SEED', ''))
 
     def get_date(self, entry):
-        published_date = getattr(entry, 'published_parsed', False) or getattr(entry, 'updated_parsed', False)
-        if isinstance(published_date, time.struct_time):
-            return published_date
-        # pdb.set_trace()
-        return time.struct_time(datetime.datetime.now().replace(hour=0, minute=0, second=0).timetuple())
-
-    def make_date_clear(self, entries):
-        for entry in entries:
-            entry['published'] = "{} {}".format(entry['published'][:10], entry['published'][11:16])
-        return entries
-
-
-    def delete_duplicate_articles(self, articles):
-        unique_articles = []
-        unique_paths = set()
-        for line in articles:
-            url_path = urlparse(line['url']).path
-            if url_path in unique_paths:
-                continue
-            unique_articles.append(line)
-            unique_paths.add(url_path)
-        return unique_articles
+        return get_date(entry)
+
+
+class CategoryStreamView(CategoryView):
+    """Server-sent events with articles of feeds which were missing in cache when category
+    page was rendered (see FEED_STREAMING). Every feed is sent as soon as it is downloaded,
+    so first articles wait for the fastest source, not for the slowest one. Records cached
+    after the page was rendered (?since=timestamp) are sent right away"""
+
+    def get(self, request, *args, **kwargs):
+        keys, missing_sources, new_entries = self.get_stream_state()
+        response = StreamingHttpResponse(
+            self.stream_articles(keys, missing_sources, new_entries), content_type='text/event-stream'
+        )
+        response['Cache-Control'] = 'no-cache'
+        response['X-Accel-Buffering'] = 'no'
+        return response
+
+    def get_stream_state(self):
+        """:returns
+        (dictionary {link: cache key}, sources whose feeds have to be downloaded,
+        entries of feeds cached after the page was rendered)"""
+        category = self.category
+        try:
+            since = float(self.request.GET.get('since', 0))
+        except ValueError:
+            since = 0
+        sources = category.sources.all()
+        keys = feed_keys(category.id, [site.link for site in sources])
+        feed_records = get_feeds(keys)
+        missing_sources = [site for site in sources if site.link not in feed_records and not is_backing_off(site)]
+        new_entries = [record.entries for record in feed_records.values() if record.fetched >= since]
+        # matcher has to be ready before streaming
+        self.tag_matcher
+        return keys, missing_sources, new_entries
+
+    def stream_articles(self, keys, missing_sources, new_entries):
+        if new_entries:
+            yield self.event('articles', self.newest_articles(new_entries))
+        built_links = set()
+        for link, record in iter_build_feeds(keys, [site.link for site in missing_sources], self.iter_refresh_feeds):
+            built_links.add(link)
+            if record.entries:
+                yield self.event('articles', self.newest_articles([record.entries]))
+        record_attempts(missing_sources, built_links)
+        yield self.event('done', [])
+
+    def event(self, name, data):
+        return "event: {}\ndata: {}\n\n".format(name, json.dumps(data, default=ArticleRecord.as_json))
+
+
+class SearchView(GeneralView):
+    """Search of articles saved by ingest_feeds, in all categories or in category given by id"""
+    http_method_names = ['get']
+    template_name = "search.html"
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        query = self.request.GET.get('q', '').strip()
+        category = Category.objects.get(id=kwargs['id']) if 'id' in kwargs else None
+        with timed('search', category=category.id if category else None):
+            articles = search_articles(query, category.id if category else None)
+        context['query'] = query
+        context['category'] = category
+        context['articles'] = [
+            {'url': article.url,
+             'title': article.title,
+             'published': article.published.strftime('%Y-%m-%d %H:%M'),
+             'website': article.website
+             } for article in articles]
+        return context
 
 
 class CategorySourcesView(GeneralView):
@@ -168,14 +313,9 @@ class CategorySourcesView(GeneralView):
         return context
 
 
-class GeneralCreateView(CreateView):
+class GeneralCreateView(CategoriesMixin, CreateView):
     """General class for create view"""
 
-    def get_context_data(self, **kwargs):
-        context = super(GeneralCreateView, self).get_context_data(**kwargs)
-        context['categories'] = Category.objects.all()
-        return context
-
 
 class SourceCreateView(GeneralCreateView):
     model = Source
@@ -189,20 +329,34 @@ class SourceCreateView(GeneralCreateView):
         return context
 
     def form_valid(self, form):
-        response = super(SourceCreateView, self).form_valid(form)
         link = form.cleaned_data.get('link')
-        parsed = feedparser.parse(link)
-        entries = parsed.entries
-        if len(entries) == 0:
-            form.add_error('link', "To nie jest feed RSS!")
-            return self.form_invalid(form)
         category_id = self.kwargs.get('id', None)
-        category = Category.objects.get(id=category_id)
+        category = Category.objects.prefetch_related('search_tags').get(id=category_id)
         if check_if_source_exists(category, link):
             form.add_error('link', "Dodawałeś już ten feed dla kategorii {}".format(category.name))
             return self.form_invalid(form)
-        category.sources.add(form.instance)
-        return response
+        try:
+            parsed_feed = fetch_feed(link)
+        except Exception:
+            form.add_error('link', "Nie udało się pobrać feedu, spróbuj później")
+            return self.form_invalid(form)
+        if len(parsed_feed.entries) == 0:
+            form.add_error('link', "To nie jest feed RSS!")
+            return self.form_invalid(form)
+        # feed subscribed by other categories keeps its source
+        self.object = get_sources({link: form.cleaned_data.get('name')})[link]
+        category.sources.add(self.object)
+        bump_versions_on_commit(bump_page_version, [category.id])
+        self.warm_feed_cache(category, self.object.link, parsed_feed)
+        return redirect(self.get_success_url())
+
+    def warm_feed_cache(self, category, link, parsed_feed):
+        """Saves feed downloaded during validation in cache, so that category page does not download it again"""
+        shared_feed = store_shared_feed(shared_feed_keys([link]), link, parsed_feed)
+        view = CategoryView()
+        view.setup(self.request, id=category.id)
+        view.category = category
+        set_feeds(feed_keys(category.id, [link]), view.build_records({link: shared_feed}))
 
 
 class CategoryCreateView(GeneralCreateView):
@@ -211,6 +365,12 @@ class CategoryCreateView(GeneralCreateView):
     fields = ['name']
     success_url = '/'
 
+    def form_valid(self, form):
+        response = super().form_valid(form)
+        # new category appears in navigation bar of every page
+        bump_versions_on_commit(bump_pages_version)
+        return response
+
 
 class TagCreateView(GeneralCreateView):
     model = SearchTag
@@ -234,13 +394,15 @@ class TagCreateView(GeneralCreateView):
         category_id = self.kwargs.get('id', None)
         category = Category.objects.get(id=category_id)
         if formset.is_valid():
-            cache.clear()
+            new_tags = []
             for instance in formset.forms:
                 new_tag = instance.cleaned_data.get('name', None)
                 if new_tag:
                     new_tag_instance = SearchTag(name=new_tag)
                     new_tag_instance.save()
-                    category.search_tags.add(new_tag_instance)
+                    new_tags.append(new_tag_instance)
+            category.search_tags.add(*new_tags)
+            bump_versions_on_commit(bump_category_version, [category.id])
             response = redirect(self.get_success_url())
             return response
 
@@ -251,7 +413,6 @@ class FindSourcesView(GeneralView):
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
-        context['categories'] = Category.objects.all()
         context['form'] = FindSourceForm()
         return context
 
@@ -263,28 +424,17 @@ class FindSourcesView(GeneralView):
             discovered_feeds = self.get_all_rss(link)
             discovered_feeds = self.get_suggested_categories(discovered_feeds)
         form = DiscoveredSourceForm()
-        categories = Category.objects.all()
-        return render(request, "source/discovered.html", {'categories': categories, "discovered_feeds": discovered_feeds, 'form': form})
+        # form is rendered for every discovered feed, choices are read once
+        form.fields['category'].choices = list(form.fields['category'].choices)
+        return render(request, "source/discovered.html", {'categories': self.categories, "discovered_feeds": discovered_feeds, 'form': form})
 
     def get_all_rss(self, website_link: str):
-        homepage = requests.get(website_link)
-        homepage_soup = BeautifulSoup(homepage.text, 'html.parser')
-        homepage_rss_feeds = homepage_soup.findAll(type='application/rss+xml')
-        homepage_rss_feeds = homepage_rss_feeds + homepage_soup.findAll('a',
-                                                                        {
-                                                                            "href": re.compile("/(?!.*/).*(rss|xml)")
-                                                                        }
-                                                                        )
-
-        parsed_link = urlparse(website_link)
-        for link in homepage_rss_feeds:
-            if not link['href'].startswith("http"):
-                link['href'] = parsed_link.scheme + "://" + parsed_link.netloc + link['href']
-
-        homepage_rss_feeds = set([link['href'] for link in homepage_rss_feeds if (
-            "?" not in link['href'] and "video" not in link['href'] and "script" not in link['href'])])
-
-        return homepage_rss_feeds
+        # FeedASGIHandler discovers feeds before the view runs
+        discovered_feeds = getattr(self.request, 'discovered_feeds', {})
+        if website_link in discovered_feeds:
+            return discovered_feeds[website_link]
+        with timed('discovery'):
+            return discover_feeds(website_link)
 
     def get_suggested_categories(self, discovered_feeds):
         """method checks keywords in each feed url, and attach  names of categories which
@@ -295,7 +445,8 @@ class FindSourcesView(GeneralView):
         discovered_feeds_with_categories - list of dictionaries, each contain url of feed and
         list of categories which match the most
         dictionary struct: {'url': url, 'categories': categories}"""
-        categories = Category.objects.all()
+        categories = self.categories
+        prefetch_related_objects(categories, 'search_tags')
 
         categories_tags = {
             cat.name: [t.name for t in cat.search_tags.all()]
@@ -322,6 +473,30 @@ class FindSourcesView(GeneralView):
         return any([tag in feed for tag in category_tags])
 
 
+class OpmlImportView(GeneralView):
+    """Import of many sources from OPML file, feeds are validated concurrently"""
+    http_method_names = ['get', 'post']
+    template_name = "source/opml.html"
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context.setdefault('form', OpmlImportForm())
+        return context
+
+    def post(self, request):
+        form = OpmlImportForm(request.POST, request.FILES)
+        result = None
+        if form.is_valid():
+            try:
+                feeds = parse_opml(form.cleaned_data['file'].read())
+            except ValueError:
+                form.add_error('file', "To nie jest plik OPML")
+            else:
+                with timed('import'):
+                    result = import_feeds(feeds, form.cleaned_data['category'])
+        return self.render_to_response(self.get_context_data(form=form, result=result))
+
+
 class AddDiscoveredSourceView(View):
 
     def get(self, request):
@@ -336,9 +511,8 @@ class AddDiscoveredSourceView(View):
             source_name = form.cleaned_data.get('name')
             source_url = form.data.get('link')
             category_obj = form.cleaned_data.get('category')
-            new_source = Source(name=source_name, link=source_url)
-            new_source.save()
-            category_obj.sources.add(new_source)
+            category_obj.sources.add(get_sources({source_url: source_name})[source_url])
+            bump_versions_on_commit(bump_page_version, [category_obj.id])
 
         return JsonResponse({})
 
@@ -359,15 +533,73 @@ class DeleteSourceView(DefaultDeleteView):
 
     def get(self, request, *args, **kwargs):
         site = Source.objects.get(id=kwargs['pk'])
-        try_cache = cache.get("cache_{}".format(site.link))
-        try_cache_formatted = cache.get("formatted_{}".format(site.link))
-        if try_cache:
-            cache.delete("cache_{}".format(site.link))
-        if try_cache_formatted:
-            cache.delete("formatted_{}".format(site.link))
-        return self.post(request, *args, **kwargs)
+        category_ids = list(site.category_set.values_list('id', flat=True))
+        response = self.post(request, *args, **kwargs)
+        bump_versions_on_commit(bump_source_version, [site.link])
+        bump_versions_on_commit(bump_page_version, category_ids)
+        return response
+
+
+class RemoveCategorySourceView(View):
+    """Removes source from category, source which no other category subscribes is deleted"""
+
+    def get(self, request, category_id, pk):
+        category = Category.objects.get(id=category_id)
+        source = Source.objects.get(id=pk)
+        category.sources.remove(source)
+        bump_versions_on_commit(bump_page_version, [category.id])
+        if not source.category_set.exists():
+            source.delete()
+            bump_versions_on_commit(bump_source_version, [source.link])
+        return redirect(request.META.get('HTTP_REFERER', reverse_lazy('category-sources', kwargs={'id': category_id})))
 
 
 class DeleteTagView(DefaultDeleteView):
     model = SearchTag
     success_url = reverse_lazy("category-view")
+
+    def get(self, request, *args, **kwargs):
+        # tag may belong to many categories, see Category.search_tags
+        category_ids = list(self.get_object().category_set.values_list('id', flat=True))
+        response = self.post(request, *args, **kwargs)
+        bump_versions_on_commit(bump_category_version, category_ids)
+        return response
+
+
+def metrics_view(request):
+    """Metrics of feed pipeline in Prometheus text format"""
+    return HttpResponse(render_metrics(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+def opml_export_view(request):
+    """All categories with their sources as OPML file"""
+    categories = Category.objects.prefetch_related('sources')
+    response = HttpResponse(render_opml(categories), content_type='text/x-opml; charset=utf-8')
+    response['Content-Disposition'] = 'attachment; filename="dailyfeed.opml"'
+    return response
+
+
+@require_GET
+def category_articles_api(request, id):
+    """Articles of category saved by ingest_feeds as JSON, newest first. ?cursor= of previous
+    response gives the next page, ?since= of previous response gives only articles saved after it.
+    Response which did not change since the client's copy is not sent again (ETag)"""
+    get_object_or_404(Category, id=id)
+    cursor = request.GET.get('cursor') or None
+    try:
+        if cursor:
+            decode_cursor(cursor)
+        since = int(request.GET.get('since', 0))
+        limit = min(max_page_size, max(1, int(request.GET.get('limit', default_page_size))))
+    except ValueError:
+        return JsonResponse({'error': "Nieprawidłowy parametr cursor, since lub limit"}, status=400)
+    etag = articles_etag(id, request.GET.urlencode())
+    response = get_conditional_response(request, etag=etag)
+    if response is None:
+        with timed('query', category=id):
+            last_id = newest_article_id(id)
+            articles, next_cursor = get_articles_page(id, cursor, since, limit)
+        response = JsonResponse({'articles': articles, 'next_cursor': next_cursor, 'since': last_id})
+    response['ETag'] = etag
+    response['Cache-Control'] = 'no-cache'
+    return response